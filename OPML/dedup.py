@@ -0,0 +1,118 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2011 Henry Obein <henry@itaapy.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from hashlib import md5
+from urlparse import urlsplit, urlunsplit
+import re
+
+
+# Below this size (in characters) the content is not significant enough
+# to identify an article
+fingerprint_min_size = 40
+
+tags_expr = re.compile(r'<[^>]*>')
+spaces_expr = re.compile(r'\s+', re.UNICODE)
+
+
+def to_str(value):
+    if type(value) is unicode:
+        return value.encode('utf-8')
+    return str(value)
+
+
+
+def normalize_link(link):
+    """Return the link without what does not change the target: the case
+    of the host, the "www." prefix, the default ports, the trailing slash,
+    the fragment and the tracking parameters.
+    """
+    link = to_str(link).strip()
+    try:
+        scheme, netloc, path, query, fragment = urlsplit(link)
+    except ValueError:
+        return link
+    scheme = scheme.lower()
+    netloc = netloc.lower()
+    if netloc.startswith('www.'):
+        netloc = netloc[4:]
+    if scheme == 'http' and netloc.endswith(':80'):
+        netloc = netloc[:-3]
+    elif scheme == 'https' and netloc.endswith(':443'):
+        netloc = netloc[:-4]
+    # http and https copies are the same article
+    if scheme == 'https':
+        scheme = 'http'
+    path = path.rstrip('/')
+    query = [ x for x in query.split('&')
+              if x and not x.startswith('utm_') ]
+    query = '&'.join(sorted(query))
+    return urlunsplit((scheme, netloc, path, query, ''))
+
+
+
+def get_fingerprint(title, description):
+    """Return a fingerprint of the content, the markup and the spaces are
+    ignored. Return None if the content is too short to be significant.
+    """
+    text = u'%s %s' % (title or u'', tags_expr.sub(u' ', description or u''))
+    text = spaces_expr.sub(u' ', text).strip().lower()
+    if len(text) < fingerprint_min_size:
+        return None
+    return md5(text.encode('utf-8')).hexdigest()
+
+
+
+def get_article_keys(article):
+    """Return the keys identifying the article (not sanitized yet): the
+    guid, the normalized link and the fingerprint of the content.
+    """
+    keys = []
+    guid = article.get('guid')
+    if guid:
+        keys.append('guid:%s' % to_str(guid).strip())
+    link = article.get('link')
+    if link:
+        keys.append('link:%s' % normalize_link(link))
+    fingerprint = get_fingerprint(article.get('title'),
+                                  article.get('description'))
+    if fingerprint:
+        keys.append('content:%s' % fingerprint)
+    return tuple(keys)
+
+
+
+class DedupIndex(object):
+    """Index of the articles kept by a refresh, the feeds are added in
+    order, the first feed carrying an article owns it.
+    """
+
+    def __init__(self):
+        # {key: (uri, article)}
+        self.keys = {}
+
+
+    def lookup(self, keys):
+        for key in keys:
+            owner = self.keys.get(key)
+            if owner is not None:
+                return owner
+        return None
+
+
+    def add(self, uri, article, keys):
+        for key in keys:
+            self.keys.setdefault(key, (uri, article))
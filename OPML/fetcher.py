@@ -0,0 +1,93 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2011 Henry Obein <henry@itaapy.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from Queue import Queue, Empty
+from threading import Event, Lock, Thread
+from traceback import format_exc
+
+
+
+class FetchTimeout(Exception):
+    pass
+
+
+
+def fetch_all(keys, fetch, max_workers=8, deadline=None):
+    """Call "fetch(key)" for every key, using at most "max_workers"
+    threads at the same time.
+
+    Return a dict {key: (result, error, details)}. The keys which are not
+    fetched before the "deadline" (in seconds) get a FetchTimeout error.
+    """
+    # Keep the order, skip the duplicates
+    seen = set()
+    keys = [ key for key in keys
+             if key not in seen and not seen.add(key) ]
+    if not keys:
+        return {}
+
+    queue = Queue()
+    for key in keys:
+        queue.put(key)
+
+    results = {}
+    lock = Lock()
+    done = Event()
+    state = {'remaining': len(keys), 'expired': False}
+
+    def worker():
+        while True:
+            # The deadline is over, do not start another download
+            if state['expired']:
+                return
+            try:
+                key = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                value = (fetch(key), None, None)
+            except Exception, e:
+                value = (None, e, format_exc())
+            lock.acquire()
+            try:
+                if state['expired'] is False:
+                    results[key] = value
+                state['remaining'] -= 1
+                if state['remaining'] == 0:
+                    done.set()
+            finally:
+                lock.release()
+
+    for i in range(min(max_workers, len(keys)) or 1):
+        thread = Thread(target=worker)
+        thread.setDaemon(True)
+        thread.start()
+
+    # Wait for the slowest download (or the deadline)
+    done.wait(deadline)
+
+    lock.acquire()
+    try:
+        state['expired'] = True
+        for key in keys:
+            if key not in results:
+                error = FetchTimeout('deadline of %ss exceeded' % deadline)
+                results[key] = (None, error, None)
+    finally:
+        lock.release()
+
+    return results
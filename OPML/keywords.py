@@ -0,0 +1,104 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2011 Henry Obein <henry@itaapy.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from threading import Lock
+import re
+
+# Import from itools
+from itools.log import log_warning
+
+
+
+class KeywordsMatcher(object):
+    """Match a text against all the keywords at once, with a single
+    compiled pattern.
+
+    By default the keywords are regular expressions, in literal mode they
+    are searched as they are.
+    """
+
+    def __init__(self, keywords, literal=False):
+        keywords = tuple(keywords)
+        self.key = (literal, keywords)
+        # An empty keyword matches every text
+        self.match_all = '' in keywords
+
+        patterns = []
+        for keyword in keywords:
+            if not keyword:
+                continue
+            if literal is False:
+                try:
+                    re.compile(keyword)
+                except re.error, e:
+                    log_warning('rssfeeds, invalid keyword "%s": %s, '
+                                'searched as literal' % (keyword, e),
+                                domain='itws')
+                else:
+                    patterns.append('(?:%s)' % keyword)
+                    continue
+            patterns.append(re.escape(keyword))
+
+        self.patterns = []
+        if patterns and not self.match_all:
+            try:
+                pattern = re.compile('|'.join(patterns), re.UNICODE)
+            except re.error, e:
+                # The keywords can not be combined (same group names,
+                # backreferences...), search them one by one
+                log_warning('rssfeeds, keywords not combined: %s' % e,
+                            domain='itws')
+                self.patterns = [ re.compile(x, re.UNICODE)
+                                  for x in patterns ]
+            else:
+                self.patterns = [pattern]
+
+
+    def match(self, *texts):
+        """Return True if any of the texts (already lower case) contains
+        any of the keywords.
+        """
+        if self.match_all:
+            return True
+        for pattern in self.patterns:
+            for text in texts:
+                if pattern.search(text):
+                    return True
+        return False
+
+
+
+# Compiled matchers {(literal, keywords): matcher}
+matchers_cache = {}
+matchers_cache_lock = Lock()
+matchers_cache_size = 500
+
+def get_keywords_matcher(keywords, literal=False):
+    key = (literal, tuple(keywords))
+    matcher = matchers_cache.get(key)
+    if matcher is not None:
+        return matcher
+
+    matcher = KeywordsMatcher(keywords, literal)
+    matchers_cache_lock.acquire()
+    try:
+        if len(matchers_cache) >= matchers_cache_size:
+            matchers_cache.clear()
+        matchers_cache[key] = matcher
+    finally:
+        matchers_cache_lock.release()
+    return matcher
@@ -21,16 +21,19 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from the Standard Library
-from copy import deepcopy
+from cPickle import dump, load, HIGHEST_PROTOCOL
+from cStringIO import StringIO
+from csv import reader, writer
 from datetime import datetime, timedelta
+from hashlib import md5
 from operator import itemgetter
+from os import getpid, makedirs, rename
+from os.path import dirname, exists, getmtime, join
+from threading import Thread
+from time import time
 from traceback import format_exc
-import re
-import socket
-import urllib2
 
 # Import from itools
-from itools import __version__ as itools_version
 from itools.core import get_abspath, merge_dicts
 from itools.csv import CSVFile
 from itools.datatypes import Boolean, Integer, URI, Unicode, String, HTTPDate
@@ -42,7 +45,8 @@ from itools.log import log_warning
 from itools.rss import RSSFile
 from itools.stl import stl, set_prefix
 from itools.uri import get_reference
-from itools.web import BaseView, INFO, ERROR, STLView
+from itools.web import BaseView, INFO, ERROR, NotModified, STLView
+from itools.web import get_context
 from itools.xml import XMLParser, stream_to_str, XMLError
 
 # Import from ikaaro
@@ -53,12 +57,23 @@ from ikaaro.text_views import CSV_View as BaseCSV_View, CSV_EditRow, CSV_AddRow
 from ikaaro.views_new import NewInstance
 
 # Import from itws
+from dedup import DedupIndex, get_article_keys
+from fetcher import fetch_all
+from keywords import get_keywords_matcher
+from itws.cache import single_flight
+from itws.control_panel import CPFetchMetrics, CPFetchMetrics_JSON
+from itws.control_panel import ITWS_ControlPanel, context_menus
+from itws.http_client import http_get
+from itws.metrics import record_fetch
 from itws.views import FieldsAutomaticEditView
 
 
 
 rss_default_pub_date = datetime(1970, 1, 1)
 
+# Format of the persistent cache
+cache_version = 6
+
 ######################################################################
 # Views
 ######################################################################
@@ -94,6 +109,10 @@ class RssFeeds_View(STLView):
         is_allowed_to_edit = ac.is_allowed_to_edit(context.user, resource)
         articles, errors = resource.get_articles()
         see_errors = is_allowed_to_edit and errors
+        if see_errors:
+            errors = [ XMLParser(x) for x in errors ]
+        # Every article once, even if carried by several feeds
+        total_nb_articles = len(articles)
 
         # Filter
         feed_filter = context.get_query_value('feed')
@@ -116,13 +135,15 @@ class RssFeeds_View(STLView):
             feed_filter = 'all'
 
         # sort by publication date
-        articles.sort(key=lambda x: x['pubDate'], reverse=True)
-        for article in articles:
-            article['formated_pubDate'] = format_date(article['pubDate'],
-                                                      accept)
+        articles = sorted(articles, key=lambda x: x['pubDate'], reverse=True)
+        # The descriptions are kept as XHTML, parse them only to render
+        articles = [ merge_dicts(article,
+                         description=XMLParser(article['description']),
+                         formated_pubDate=format_date(article['pubDate'],
+                                                      accept))
+                     for article in articles ]
         # Filter
         feeds = []
-        total_nb_articles = 0
         for uri, data in feeds_cache.iteritems():
             nb_articles = data['nb_articles']
             if nb_articles:
@@ -133,7 +154,6 @@ class RssFeeds_View(STLView):
                 feeds.append({'title': title, 'uri': uri,
                               'nb_articles': data['nb_articles'],
                               'selected': feed_filter == uri})
-                total_nb_articles += nb_articles
 
         # sort by title
         nb_articles_format = '%{0}d'.format(len(str(total_nb_articles)))
@@ -164,15 +184,86 @@ class FeedRSS_OPML(BaseView):
 
 
     def get_mtime(self, resource):
-        return resource.handler.last_download_time
+        # The export changes with the configuration and the refreshs
+        handler = resource._update_if_needed()
+        mtime = resource.get_mtime()
+        last_download_time = handler.last_download_time
+        if last_download_time is None or mtime > last_download_time:
+            return mtime
+        return last_download_time
 
 
     def GET(self, resource, context):
+        etag, data = resource.get_opml(context)
+        context.set_header('ETag', etag)
+        if context.get_header('If-None-Match') == etag:
+            raise NotModified
         # Content-Type
         context.set_content_type('text/opml')
         context.set_content_disposition('attachment', 'rss-agregator.opml')
-        stream = resource.to_opml_stream(context)
-        return stream_to_str(stream)
+        return data
+
+
+
+class RssFeeds_RefreshStatus(STLView):
+
+    access = 'is_allowed_to_edit'
+    title = MSG(u'Refresh status')
+    description = MSG(u'Last and next refresh of the feeds')
+    itws_icon = 'rss-refresh.png'
+    template = '/ui/rssfeeds/RssFeeds_refresh_status.xml'
+    context_menus = context_menus
+
+
+    def get_namespace(self, resource, context):
+        handler = resource.handler
+        format_datetime = context.format_datetime
+
+        last_refresh = handler.last_download_time
+        if last_refresh:
+            last_refresh = format_datetime(last_refresh)
+        duration = handler.last_refresh_duration
+        if duration is not None:
+            duration = '%.2f' % (duration.seconds +
+                                 duration.microseconds / 1000000.0)
+        next_refresh = resource.get_next_refresh_time()
+        if next_refresh:
+            next_refresh = format_datetime(next_refresh)
+        refresh_start = handler.refresh_start_time
+        if refresh_start:
+            refresh_start = format_datetime(refresh_start)
+
+        # Schedule of every feed
+        now = datetime.now()
+        feeds_state = handler.feeds_state or {}
+        hosts_state = handler.hosts_state or {}
+        feeds = []
+        for uri, keywords, active, ttl in handler.get_rows():
+            if active is False:
+                continue
+            state = feeds_state.get(uri) or {}
+            circuit = hosts_state.get(get_reference(uri).authority)
+            next_feed_refresh = state.get('next_refresh')
+            if next_feed_refresh:
+                next_feed_refresh = format_datetime(next_feed_refresh)
+            last_success = state.get('last_success')
+            if last_success:
+                last_success = format_datetime(last_success)
+            feeds.append({'uri': uri,
+                          'next_refresh': next_feed_refresh,
+                          'failures': state.get('failures', 0),
+                          'last_success': last_success,
+                          'circuit_open': circuit is not None and
+                              circuit['open_until'] is not None and
+                              circuit['open_until'] > now})
+
+        background = resource.get_property('background_refresh')
+        return {'background': background,
+                'feeds': feeds,
+                'last_refresh': last_refresh,
+                'duration': duration,
+                'next_refresh': next_refresh,
+                'refresh_start': refresh_start}
 
 
 
@@ -225,33 +316,59 @@ class RssFeedsFile(CSVFile):
 
     schema = {'uri': URI(mandatory=True, default=''),
               'keywords': Unicode(),
-              'active': Boolean(default=False)}
+              'active': Boolean(default=False),
+              'ttl': Integer()}
 
-    columns = ['uri', 'keywords', 'active']
+    columns = ['uri', 'keywords', 'active', 'ttl']
 
     # Cache API
     last_download_time = None
     last_articles = None
     feeds_summary = None
     errors = None
+    feeds_state = None
+    last_refresh_duration = None
+    refresh_start_time = None
+    cache_mtime = None
+    cache_path = None
+    hosts_state = None
+    feeds_index = None
+    # The last OPML export (key, etag, data)
+    opml_cache = None
 
 
 
 class RssFeeds(CSV):
 
     class_id = 'rssfeeds'
-    class_version = '20100618'
+    class_version = '20110701'
     class_title = MSG(u'RSS Feeds')
     class_description = MSG(u'RSS feeds allow to aggregate external feeds, '
                             u'filtering content by keywords')
     class_icon16 = 'rssfeeds/icons/16x16/rss_feeds.png'
     class_icon48 = 'rssfeeds/icons/48x48/rss_feeds.png'
-    class_views = ['view', 'edit', 'add_row', 'configure']
+    class_views = ['view', 'edit', 'add_row', 'configure', 'control_panel']
+    class_control_panel = ['refresh_status', 'fetch_metrics']
     class_handler = RssFeedsFile
     class_schema = merge_dicts(
             CSV.class_schema,
             TTL=Integer(source='metadata', default=15),
-            timeout=Decimal(source='metadata', default=1.0))
+            timeout=Decimal(source='metadata', default=1.0),
+            max_connections=Integer(source='metadata', default=8,
+                title=MSG(u'Number of feeds downloaded at the same time')),
+            deadline=Decimal(source='metadata', default=10.0,
+                title=MSG(u'Maximum time to refresh all the feeds (s)')),
+            literal_keywords=Boolean(source='metadata', default=False,
+                title=MSG(u'Search the keywords as plain text (not as '
+                          u'regular expressions)')),
+            background_refresh=Boolean(source='metadata', default=False,
+                title=MSG(u'Refresh the feeds in background (visitors get '
+                          u'the cached version meanwhile)')),
+            max_backoff=Integer(source='metadata', default=240,
+                title=MSG(u'Maximum delay before retrying a broken feed '
+                          u'(minutes)')),
+            circuit_breaker_threshold=Integer(source='metadata', default=3,
+                title=MSG(u'Number of failures before skipping a host')))
 
     # Hide itws sidebar
     display_sidebar = False
@@ -265,170 +382,634 @@ class RssFeeds(CSV):
     export_to_opml = FeedRSS_OPML()
     configure = FieldsAutomaticEditView(
                     title=MSG(u'Configure'),
-                    edit_fields=['title', 'TTL', 'timeout'])
+                    edit_fields=['title', 'TTL', 'timeout',
+                                 'max_connections', 'deadline',
+                                 'literal_keywords', 'background_refresh',
+                                 'max_backoff',
+                                 'circuit_breaker_threshold'])
+    control_panel = ITWS_ControlPanel()
+    refresh_status = RssFeeds_RefreshStatus()
+    fetch_metrics = CPFetchMetrics()
+    fetch_metrics_json = CPFetchMetrics_JSON()
 
     def get_columns(self):
         return [('uri', MSG(u'URL')),
                 ('keywords', MSG(u'Keywords (Separated by comma)')),
-                ('active', MSG(u'Active'))]
-
-
-    def update_rss(self):
-        handler = self.handler
+                ('active', MSG(u'Active')),
+                ('ttl', MSG(u'Refresh interval (minutes, empty for the '
+                            u'default)'))]
+
+
+    def _download_feed(self, uri, timeout, etag=None, last_modified=None):
+        # Conditional GET
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        response = http_get(uri, headers, timeout=timeout)
+        if response.status == 304:
+            # Not modified
+            return {'status': 304, 'data': None, 'etag': etag,
+                    'last_modified': last_modified,
+                    'timings': response.timings}
+        return {'status': response.status, 'data': response.data,
+                'etag': response.headers.get('etag'),
+                'last_modified': response.headers.get('last-modified'),
+                'timings': response.timings}
+
+
+    def _parse_feed(self, uri, matcher, data, index, measures):
+        """Return the channel title, the valid articles, the keys of the
+        articles already carried by another feed and the error messages of
+        the downloaded feed. The times spent are added to "measures".
+        """
         errors = []
-        errors_str = []
-        articles = []
-        feeds_summary = {}
-        # backup the default timeout
-        default_timeout = socket.getdefaulttimeout()
-        socket.setdefaulttimeout(self.get_property('timeout'))
+        duplicates = []
+
+        # Parse
+        t0 = time()
+        try:
+            feed = RSSFile(string=data)
+        except Exception, e:
+            msg = '%s <br />-- Error parsing: "%s"'
+            msg = msg % (XMLContent.encode(str(uri)), e)
+            errors.append(msg.encode('utf-8'))
+            summary = ('rssfeeds, Error parsing feed\n'
+                       'uri: %s\n\n' % str(uri))
+            details = format_exc()
+            log_warning(summary + details, domain='itws')
+            return None, [], errors, duplicates
+        finally:
+            measures['parse_time'] = time() - t0
+
+        # Check
+        t0 = time()
+        feed_articles = []
+        for item in feed.items:
+            # Check if description is available
+            if item.get('description') is None:
+                # Invalid item (not well formed)
+                continue
+            item['pubDate_valid'] = True
+            if not item.has_key('pubDate'):
+                item['pubDate'] = rss_default_pub_date
+                item['pubDate_valid'] = False
+            item['channel'] = feed.channel
+            # Add the Article if correspond to keywords
+            if not matcher.match(item['title'].lower(),
+                                 item['description'].lower()):
+                continue
+            # Skip the copies, before the expensive sanitize
+            keys = get_article_keys(item)
+            owner = index.lookup(keys)
+            if owner is not None and owner[0] != uri:
+                duplicates.append(keys)
+                continue
+            item['dedup_keys'] = keys
+            index.add(uri, item, keys)
+            feed_articles.append(item)
+
+        # Check if the articles are well formed
+        for article in feed_articles:
+            article['valid'] = True
+            description = article['description'].encode('utf-8')
+            try:
+                description = HTMLParser(description)
+                # Serialized to XHTML by _post_process_articles
+                article['description'] = list(sanitize_stream(description))
+            except (XMLError, UnicodeDecodeError), e:
+                article['valid'] = False
+                msg = '%s <br />-- Error on article: "%s"<br />-- "%s"'
+                msg = msg % (XMLContent.encode(str(uri)), e,
+                             article['title'])
+                errors.append(msg.encode('utf-8'))
+                summary = ('rssfeeds, Error sanitizing feed\n'
+                           'uri: %s\n\n' % str(uri))
+                details = format_exc()
+                log_warning(summary + details, domain='itws')
 
-        # Download the feeds
-        for uri, keywords, active in handler.get_rows():
-            if active is False:
+        # Skip invalid articles
+        feed_articles = [ article for article in feed_articles
+                          if article['valid'] ]
+        self._post_process_articles(uri, feed_articles)
+        measures['sanitize_time'] = time() - t0
+        measures['nb_items'] = len(feed.items)
+        # Channel is not well formed -> no attribute title
+        title = feed.channel.get('title')
+        return title, feed_articles, errors, duplicates
+
+
+    def _post_process_articles(self, uri, feed_articles):
+        """Run once per article, when the feed is parsed: resolve the
+        links of the content against the feed URI and compute the anchor.
+        """
+        uri_ref = get_reference(uri)
+        for article in feed_articles:
+            # Set prefix with url for article content
+            description = set_prefix(article['description'], prefix='.',
+                                     uri=uri_ref)
+            # Keep the XHTML, much smaller than the events
+            article['description'] = stream_to_str(description)
+            # Stable anchor, the same from one refresh to another
+            key = article.get('guid') or article.get('link')
+            if not key:
+                key = article['title']
+            if type(key) is unicode:
+                key = key.encode('utf-8')
+            article['anchor_id'] = md5('%s %s' % (uri, key)).hexdigest()[:10]
+
+
+    def _get_refresh_parameters(self):
+        """Read everything the refresh needs from the database, so the
+        refresh itself may run outside of the request.
+        """
+        uris = []
+        feeds = {}
+        ttls = {}
+        default_ttl = self.get_property('TTL')
+        literal = self.get_property('literal_keywords')
+        for uri, keywords, active, ttl in self.handler.get_rows():
+            if active is False or uri in feeds:
                 continue
             keywords = [x.strip().lower() for x in keywords.split(',')]
+            uris.append(uri)
+            feeds[uri] = get_keywords_matcher(keywords, literal)
+            ttls[uri] = ttl or default_ttl
+
+        return {'uris': uris,
+                'feeds': feeds,
+                'ttls': ttls,
+                'max_backoff': self.get_property('max_backoff'),
+                'circuit_breaker_threshold':
+                    self.get_property('circuit_breaker_threshold'),
+                'timeout': float(self.get_property('timeout')),
+                'max_connections': self.get_property('max_connections'),
+                'deadline': float(self.get_property('deadline')),
+                'abspath': str(self.get_abspath())}
+
+
+    def _refresh(self, parameters, previous_state, previous_hosts):
+        uris = parameters['uris']
+        feeds = parameters['feeds']
+        abspath = parameters['abspath']
+        # State of the previous refresh {uri: {'etag', 'last_modified',
+        # 'hash', 'keywords', 'title', 'articles', 'errors',
+        # 'network_error', 'next_refresh', 'failures', 'last_success'}}
+        previous_state = previous_state or {}
+        feeds_state = {}
+        # Circuit breaker {host: {'failures', 'open_until'}}
+        hosts_state = dict(previous_hosts or {})
+        now = datetime.now()
 
-            # TODO Use itools.vfs instead of urllib2
-            try:
-                req = urllib2.Request(uri)
-                req.add_header('User-Agent', 'itools/%s' % itools_version)
-                response = urllib2.urlopen(req)
-                data = response.read()
-            except (socket.error, socket.gaierror, Exception,
-                    urllib2.HTTPError), e:
+        def get_previous_state(uri):
+            state = previous_state.get(uri)
+            # The articles are filtered by keywords, so the cache is
+            # useless if the keywords have changed
+            if state is None or state['keywords'] != feeds[uri].key:
+                return None
+            return state
+
+        timeout = parameters['timeout']
+        def download(uri):
+            state = get_previous_state(uri) or {}
+            return self._download_feed(uri, timeout, state.get('etag'),
+                                       state.get('last_modified'))
+
+        # Only download the feeds which are due
+        due = []
+        for uri in uris:
+            state = get_previous_state(uri)
+            next_refresh = state and state.get('next_refresh')
+            if next_refresh and next_refresh > now:
+                feeds_state[uri] = state
+                continue
+            host = get_reference(uri).authority
+            circuit = hosts_state.get(host)
+            open_until = circuit and circuit['open_until']
+            if open_until and open_until > now:
+                # Do not waste the timeout on a host known to be down
+                msg = '%s <br />-- Host "%s" skipped until %s'
+                msg = msg % (XMLContent.encode(str(uri)), host,
+                             open_until.strftime('%Y-%m-%d %H:%M'))
+                if state is None:
+                    state = self._get_empty_state(matcher=feeds[uri])
+                feeds_state[uri] = merge_dicts(state, network_error=msg,
+                    next_refresh=circuit['open_until'])
+                continue
+            due.append(uri)
+
+        # Download the feeds, the slowest one bounds the refresh time
+        downloads = fetch_all(due, download,
+                              max_workers=parameters['max_connections'],
+                              deadline=parameters['deadline'])
+
+        # The articles we already know, the copies found in the new content
+        # are dropped before being sanitized
+        index = DedupIndex()
+        for uri in uris:
+            state = feeds_state.get(uri) or get_previous_state(uri)
+            if state is not None:
+                for article in state['articles']:
+                    index.add(uri, article, article['dedup_keys'])
+
+        for uri in due:
+            matcher = feeds[uri]
+            ttl = timedelta(minutes=parameters['ttls'][uri])
+            host = get_reference(uri).authority
+            response, e, details = downloads[uri]
+            state = get_previous_state(uri)
+            if e is not None:
                 msg = '%s <br />-- Network error: "%s"'
                 msg = msg % (XMLContent.encode(str(uri)), e)
-                msg = msg.encode('utf-8')
-                errors.append(XMLParser(msg))
-                errors_str.append(msg)
-
                 summary = ('rssfeeds, Error downloading feed\n'
                            'uri: %s\n\n' % str(uri))
-                details = format_exc()
-                log_warning(summary + details, domain='itws')
+                log_warning(summary + (details or ''), domain='itws')
+                # Keep the last known articles and the validators
+                if state is None:
+                    state = self._get_empty_state(matcher)
+                # Exponential backoff
+                failures = state.get('failures', 0) + 1
+                delay = self._get_backoff_delay(ttl, failures, parameters)
+                feeds_state[uri] = merge_dicts(state,
+                    network_error=msg.encode('utf-8'), failures=failures,
+                    next_refresh=now + delay)
+                # Circuit breaker
+                circuit = hosts_state.get(host) or {'failures': 0}
+                failures = circuit['failures'] + 1
+                open_until = None
+                if failures >= parameters['circuit_breaker_threshold']:
+                    open_until = now + self._get_backoff_delay(ttl, failures,
+                                                               parameters)
+                hosts_state[host] = {'failures': failures,
+                                     'open_until': open_until}
+                record_fetch('rssfeeds', abspath, uri, error=e)
                 continue
 
-            # Parse
-            try:
-                feed = RSSFile(string=data)
-            except Exception, e:
-                msg = '%s <br />-- Error parsing: "%s"'
-                msg = msg % (XMLContent.encode(str(uri)), e)
-                msg = msg.encode('utf-8')
-                errors.append(XMLParser(msg))
-                errors_str.append(msg)
-                summary = ('rssfeeds, Error parsing feed\n'
-                           'uri: %s\n\n' % str(uri))
-                details = format_exc()
-                log_warning(summary + details, domain='itws')
+            # The host answered
+            hosts_state.pop(host, None)
+            measures = dict(response['timings'])
+            error = None
+            data = response['data']
+            data_hash = md5(data).hexdigest() if data is not None else None
+            if state is not None and (response['status'] == 304 or
+                                      data_hash == state['hash']):
+                # Not modified, reuse the parsed and sanitized articles
+                state = merge_dicts(state, etag=response['etag'],
+                                    last_modified=response['last_modified'],
+                                    network_error=None)
+            elif data is None:
+                # 304 without anything in cache, no validator was sent:
+                # nothing to show until the next refresh (in "ttl", not at
+                # every request), which downloads the feed again
+                state = self._get_empty_state(matcher)
+                error = 'Not modified without cached copy'
+            else:
+                title, feed_articles, feed_errors, duplicates = \
+                    self._parse_feed(uri, matcher, data, index, measures)
+                state = merge_dicts(self._get_empty_state(matcher),
+                                    etag=response['etag'],
+                                    last_modified=response['last_modified'],
+                                    hash=data_hash,
+                                    title=title,
+                                    articles=feed_articles,
+                                    duplicates=duplicates,
+                                    errors=feed_errors)
+                if title is None and not feed_articles:
+                    # Error parsing, do not cache the response
+                    state['hash'] = state['etag'] = None
+                    state['last_modified'] = None
+                    error = 'Error parsing'
+            record_fetch('rssfeeds', abspath, uri, error=error, **measures)
+            state['failures'] = 0
+            state['last_success'] = now
+            state['next_refresh'] = now + ttl
+            feeds_state[uri] = state
+
+        # The copies dropped because of an article which has disappeared
+        # since, parse the feed again on the next refresh
+        keys = set()
+        for state in feeds_state.itervalues():
+            for article in state['articles']:
+                keys.update(article['dedup_keys'])
+        for uri, state in feeds_state.items():
+            for duplicate in state['duplicates']:
+                if keys.isdisjoint(duplicate):
+                    feeds_state[uri] = merge_dicts(state, etag=None,
+                        last_modified=None, hash=None, next_refresh=now)
+                    break
+
+        result = self._merge_feeds(uris, feeds_state)
+        result['hosts_state'] = hosts_state
+        return result
+
+
+    def _get_empty_state(self, matcher):
+        return {'etag': None, 'last_modified': None, 'hash': None,
+                'keywords': matcher.key, 'title': None, 'articles': [],
+                'duplicates': [], 'errors': [], 'network_error': None,
+                'next_refresh': None, 'failures': 0, 'last_success': None}
+
+
+    def _get_backoff_delay(self, ttl, failures, parameters):
+        max_backoff = timedelta(minutes=parameters['max_backoff'])
+        # Avoid huge numbers
+        failures = min(failures, 20)
+        return min(ttl * (2 ** (failures - 1)), max(max_backoff, ttl))
+
+
+    def _merge_feeds(self, uris, feeds_state):
+        """Build the articles, the errors and the summary from the state
+        of every feed. An article carried by several feeds is kept once.
+        """
+        errors = []
+        articles = []
+        anchors = set()
+        index = DedupIndex()
+        # {uri: [article, ...]} including the copies
+        carried = {}
+        for uri in uris:
+            state = feeds_state.get(uri)
+            if state is None:
                 continue
+            messages = list(state['errors'])
+            if state.get('network_error'):
+                messages.insert(0, state['network_error'])
+            # The messages are XHTML, parsed by the view
+            errors.extend(messages)
 
-            # Check
             feed_articles = []
-            for item in feed.items:
-                # Check if description is available
-                if item.get('description') is None:
-                    # Invalid item (not well formed)
+            feed_carried = carried[uri] = []
+            for article in state['articles']:
+                keys = article['dedup_keys']
+                owner = index.lookup(keys)
+                if owner is not None and owner[0] != uri:
+                    # The feed was parsed before the owner of the article
+                    if uri not in owner[1]['feeds']:
+                        owner[1]['feeds'].append(uri)
+                        feed_carried.append(owner[1])
                     continue
-                item['pubDate_valid'] = True
-                if not item.has_key('pubDate'):
-                    item['pubDate'] = rss_default_pub_date
-                    item['pubDate_valid'] = False
-                item['channel'] = feed.channel
-                # Add the Article if correspond to keywords
-                for keyword in keywords:
-                    if (re.search(keyword, item['title'].lower()) or
-                        re.search(keyword, item['description'].lower())):
-                        feed_articles.append(item)
-                        break
-
-            # Check if the articles are well formed
-            for article in feed_articles:
-                article['valid'] = True
-                description = article['description'].encode('utf-8')
-                try:
-                    description = HTMLParser(description)
-                    article['description'] = sanitize_stream(description)
-                except (XMLError, UnicodeDecodeError), e:
-                    article['valid'] = False
-                    msg = '%s <br />-- Error on article: "%s"<br />-- "%s"'
-                    msg = msg % (XMLContent.encode(str(uri)), e,
-                                 article['title'])
-                    msg = msg.encode('utf-8')
-                    errors.append(XMLParser(msg))
-                    errors_str.append(msg)
-                    summary = ('rssfeeds, Error sanitizing feed\n'
-                               'uri: %s\n\n' % str(uri))
-                    details = format_exc()
-                    log_warning(summary + details, domain='itws')
-
-            # Skip invalid articles
-            feed_articles = [ article for article in feed_articles
-                              if article['valid'] ]
+                index.add(uri, article, keys)
+                article['feeds'] = [uri]
+                # Anchor (the same article may appear twice in a feed)
+                anchor = article['anchor_id']
+                if anchor in anchors:
+                    anchor = '%s-%d' % (anchor, len(anchors))
+                anchors.add(anchor)
+                article['anchor'] = 'anchor-%s' % anchor
+                article['reverse_anchor'] = 'reverse-anchor-%s' % anchor
+                feed_articles.append(article)
+                feed_carried.append(article)
             articles.extend(feed_articles)
-            # Generate the feed summary
 
-            try:
-                feeds_summary[uri] = {'title': feed.channel['title'],
-                                      'nb_articles': len(feed_articles),
-                                      'articles': feed_articles}
-            except KeyError:
+        # Record the feeds carrying every article
+        feeds_summary = {}
+        # The title and the number of articles of every feed, in order
+        feeds_index = []
+        for uri in uris:
+            state = feeds_state.get(uri)
+            if state is None:
+                continue
+            feed_carried = carried[uri]
+            for keys in state['duplicates']:
+                owner = index.lookup(keys)
+                if owner is not None and uri not in owner[1]['feeds']:
+                    owner[1]['feeds'].append(uri)
+                    feed_carried.append(owner[1])
+            # Generate the feed summary
+            if state['title'] is None:
                 # Channel is not well formed -> no attribute title
                 continue
-
-            # Add the anchors
-            uri_ref = get_reference(uri)
-            for number, article in enumerate(articles):
-                # Set prefix with url for article content
-                description = set_prefix(article['description'],
-                        prefix='.', uri=uri_ref)
-                # Transform generator into list
-                article['description'] = list(description)
-                # Anchor
-                article['anchor'] = 'anchor%d' % number
-                article['reverse_anchor'] = 'reverse_anchor%d' % number
-
-        # restore the default timeout
-        socket.setdefaulttimeout(default_timeout)
-
+            feeds_summary[uri] = {'title': state['title'],
+                                  'nb_articles': len(feed_carried),
+                                  'nb_duplicates': len([
+                                      x for x in feed_carried
+                                      if x['feeds'][0] != uri ]),
+                                  'articles': feed_carried}
+            feeds_index.append({'uri': uri,
+                                'title': state['title'],
+                                'nb_articles': len(feed_carried)})
+
+        return {'articles': articles,
+                'errors': errors,
+                'feeds_summary': feeds_summary,
+                'feeds_index': feeds_index,
+                'feeds_state': feeds_state}
+
+
+    def _save_refresh(self, handler, result, start_time):
         # Save informations
-        handler.last_download_time = datetime.now()
-        handler.last_articles = articles
-        list_errors = []
-        for index, x in enumerate(errors):
-            # FIXME (old comment 2010-12-27,
-            # the problem did not occurred since)
-            # if we simply append x (a generator) this cause a segfault in the
-            # xml parser
-            list_errors.append(x)
+        now = datetime.now()
+        handler.last_download_time = now
+        handler.last_refresh_duration = now - start_time
+        handler.last_articles = result['articles']
+        handler.errors = result['errors']
+        handler.feeds_summary = result['feeds_summary']
+        handler.feeds_index = result['feeds_index']
+        handler.feeds_state = result['feeds_state']
+        handler.hosts_state = result['hosts_state']
+        # Share the result with the other processes and the next start
+        self._write_cache(handler)
+
+
+    ######################################################################
+    # Persistent cache
+    ######################################################################
+    def get_cache_path(self, handler=None):
+        """The cache is kept out of the database, in the "cache" folder of
+        the instance, by path of the resource.
+        """
+        if handler is None:
+            handler = self.handler
+        if handler.cache_path is None:
+            database = get_context().database
+            instance = dirname(database.path.rstrip('/'))
+            folder = join(instance, 'cache', 'rssfeeds')
+            if not exists(folder):
+                makedirs(folder)
+            name = md5(str(self.get_abspath())).hexdigest()
+            handler.cache_path = join(folder, name)
+        return handler.cache_path
+
+
+    def _write_cache(self, handler):
+        data = {'version': cache_version,
+                'last_download_time': handler.last_download_time,
+                'feeds_state': handler.feeds_state,
+                'hosts_state': handler.hosts_state}
+
+        path = self.get_cache_path(handler)
+        tmp_path = '%s.tmp-%s' % (path, getpid())
+        try:
+            cache_file = open(tmp_path, 'wb')
+            try:
+                dump(data, cache_file, HIGHEST_PROTOCOL)
+            finally:
+                cache_file.close()
+            # Atomic
+            rename(tmp_path, path)
+            handler.cache_mtime = getmtime(path)
+        except Exception:
+            summary = 'rssfeeds, Error writing cache\npath: %s\n\n' % path
+            log_warning(summary + format_exc(), domain='itws')
+
+
+    def _load_cache(self, handler):
+        """Load the feeds from the cache written by a previous refresh
+        (maybe by another process). Return True on success.
+        """
+        path = self.get_cache_path(handler)
+        if not exists(path):
+            return False
+        mtime = getmtime(path)
+        if mtime == handler.cache_mtime:
+            # Already loaded (or written by this process)
+            return False
+        try:
+            cache_file = open(path, 'rb')
+            try:
+                data = load(cache_file)
+            finally:
+                cache_file.close()
+            if data.get('version') != cache_version:
+                return False
+            feeds_state = data['feeds_state']
+        except Exception:
+            summary = 'rssfeeds, Error reading cache\npath: %s\n\n' % path
+            log_warning(summary + format_exc(), domain='itws')
+            return False
+
+        # Only keep the feeds matching the current configuration
+        parameters = self._get_refresh_parameters()
+        feeds = parameters['feeds']
+        for uri in feeds_state.keys():
+            keywords = feeds_state[uri]['keywords']
+            if uri not in feeds or keywords != feeds[uri].key:
+                del feeds_state[uri]
+
+        result = self._merge_feeds(parameters['uris'], feeds_state)
+        handler.cache_mtime = mtime
+        handler.last_download_time = data['last_download_time']
+        handler.last_articles = result['articles']
+        handler.errors = result['errors']
+        handler.feeds_summary = result['feeds_summary']
+        handler.feeds_index = result['feeds_index']
+        handler.feeds_state = result['feeds_state']
+        handler.hosts_state = data['hosts_state']
+        return True
+
 
-        handler.errors = list_errors
-        handler.feeds_summary = feeds_summary
+    def update_rss(self):
+        handler = self.handler
+        start_time = datetime.now()
+        parameters = self._get_refresh_parameters()
+        result = self._refresh(parameters, handler.feeds_state,
+                               handler.hosts_state)
+        self._save_refresh(handler, result, start_time)
 
 
-    def get_articles(self):
-        # Download or send the cache ??
+    def refresh_in_background(self):
+        """Start a refresh in a worker thread, unless one is already
+        running for this resource. Return True if a refresh was started.
+        """
         handler = self.handler
-        now = datetime.now()
+        key = self.get_refresh_key()
+        parameters = self._get_refresh_parameters()
+        previous_state = handler.feeds_state
+        previous_hosts = handler.hosts_state
+        # Needs the context, not available in the worker
+        self.get_cache_path(handler)
+
+        def worker():
+            start_time = handler.refresh_start_time
+            try:
+                result = self._refresh(parameters, previous_state,
+                                       previous_hosts)
+                self._save_refresh(handler, result, start_time)
+            except Exception:
+                summary = ('rssfeeds, Error refreshing feeds\n'
+                           'resource: %s\n\n' % key)
+                log_warning(summary + format_exc(), domain='itws')
+            finally:
+                handler.refresh_start_time = None
+                single_flight.end(key)
+
+        if not single_flight.begin(key):
+            return False
+        handler.refresh_start_time = datetime.now()
+        thread = Thread(target=worker)
+        thread.setDaemon(True)
+        thread.start()
+        return True
+
+
+    def get_refresh_key(self):
+        return 'rssfeeds:%s' % self.get_abspath()
+
+
+    def get_next_refresh_time(self):
+        handler = self.handler
+        if handler.last_download_time is None:
+            # Warm start
+            self._load_cache(handler)
         last_download_time = handler.last_download_time
-        update_feeds_delta = timedelta(minutes=self.get_property('TTL'))
-        if (last_download_time is None or
-            now - last_download_time > update_feeds_delta):
-            self.update_rss()
+        if last_download_time is None:
+            return None
+        # Every feed has its own schedule, the soonest one wins
+        feeds_state = handler.feeds_state or {}
+        next_refresh_time = None
+        for uri, keywords, active, ttl in handler.get_rows():
+            if active is False:
+                continue
+            state = feeds_state.get(uri)
+            next_refresh = state and state.get('next_refresh')
+            if next_refresh is None:
+                # New feed
+                return last_download_time
+            if next_refresh_time is None or next_refresh < next_refresh_time:
+                next_refresh_time = next_refresh
+        if next_refresh_time is None:
+            ttl = timedelta(minutes=self.get_property('TTL'))
+            return last_download_time + ttl
+        return next_refresh_time
+
+
+    def _update_if_needed(self):
+        # Download or send the cache ??
+        handler = self.handler
+        key = self.get_refresh_key()
+        next_refresh_time = self.get_next_refresh_time()
+        if next_refresh_time is None:
+            # Nothing to serve yet, wait for the refresh in progress
+            timeout = (float(self.get_property('deadline')) +
+                       float(self.get_property('timeout')))
+            single_flight.run(key, self.update_rss, timeout)
+            if handler.last_articles is None:
+                # The refresh in progress failed or is too slow, but there
+                # is nothing to serve without it
+                self.update_rss()
+        elif datetime.now() > next_refresh_time:
+            # Maybe another process did the job
+            if self._load_cache(handler):
+                next_refresh_time = self.get_next_refresh_time()
+                if datetime.now() <= next_refresh_time:
+                    return handler
+            if self.get_property('background_refresh'):
+                # Stale while revalidate
+                self.refresh_in_background()
+            else:
+                # Only one refresh, the other requests get the stale data
+                single_flight.run(key, self.update_rss, 0)
+        return handler
+
+
+    def get_articles(self):
+        handler = self._update_if_needed()
         return handler.last_articles, handler.errors
 
 
     def get_summary(self):
-        # Download or send the cache ??
-        handler = self.handler
-        now = datetime.now()
-        last_download_time = handler.last_download_time
-        update_feeds_delta = timedelta(minutes=self.get_property('TTL'))
-        if (last_download_time is None or
-            now - last_download_time > update_feeds_delta):
-            self.update_rss()
-
+        handler = self._update_if_needed()
         return handler.feeds_summary
 
 
@@ -450,20 +1031,47 @@ class RssFeeds(CSV):
         namespace['owner'] = owner
 
         # Feeds
-        articles, errors = self.get_articles()
-        feeds_cache = deepcopy(self.handler.feeds_summary)
+        handler = self._update_if_needed()
         feeds = []
-        for uri, data in feeds_cache.iteritems():
-            feeds.append({'title': data['title'],
-                          'nb_articles': data['nb_articles'],
-                          'uri': uri,
-                          'type': 'rss' # FIXME hardcoded
-                          })
+        for feed in handler.feeds_index or []:
+            feeds.append(merge_dicts(feed, type='rss')) # FIXME hardcoded
         namespace['feeds'] = feeds
         handler = self.get_resource('/ui/rssfeeds/RssFeeds_export_to_opml.xml')
         return stl(handler, namespace=namespace)
 
 
+    def get_opml(self, context):
+        """Return the ETag and the OPML export, rendered once per
+        revision of the resource and per refresh of the feeds.
+        """
+        handler = self._update_if_needed()
+        key = (self.get_mtime(), handler.last_download_time)
+        cache = handler.opml_cache
+        if cache is None or cache[0] != key:
+            data = stream_to_str(self.to_opml_stream(context))
+            etag = '"%s"' % md5(data).hexdigest()
+            cache = handler.opml_cache = (key, etag, data)
+        return cache[1], cache[2]
+
+
+    ######################################################################
+    # Upgrade
+    ######################################################################
+    def update_20110701(self):
+        """Add the "ttl" column"""
+        handler = self.handler
+        data = handler.database.fs.open(handler.key).read()
+        lines = []
+        for row in reader(StringIO(data)):
+            if row:
+                row = row + [''] * (len(handler.columns) - len(row))
+            lines.append(row)
+        output = StringIO()
+        writer(output).writerows(lines)
+        handler.load_state_from_string(output.getvalue())
+        handler.set_changed()
+
+
 
 # Register skin
 path = get_abspath('../ui/rssfeeds')
@@ -31,6 +31,7 @@ from ikaaro.user import User
 
 import about
 import bar
+import catalog
 import news
 import feed_views
 import OPML
@@ -60,7 +61,7 @@ register_domain('itws', get_abspath('locale'))
 User.is_allowed_to_view = User.is_allowed_to_edit
 
 # Silent pyflakes
-skin, about, OPML, bar, sitemap, turning_footer, ws_neutral, webpage,
+skin, about, OPML, bar, catalog, sitemap, turning_footer, ws_neutral, webpage,
 shop, root, widgets, theme, feed_views, news, monkey_patch
 
 register_skin('itws-icons', get_abspath('ui/itws-icons'))
@@ -32,7 +32,7 @@ from navigation import BoxNavigation
 from registry import register_box
 from repository import Repository
 from section import Section
-from tags import BoxTags
+from tags import BoxRelatedContent, BoxRelatedTags, BoxTags
 from toc import BoxSectionChildrenToc, ContentBoxSectionChildrenToc
 from twitter import IdenticaSideBar, TwitterSideBar
 
@@ -41,6 +41,8 @@ register_box(BoxContact)
 register_box(BoxFeed)
 register_box(BoxGallery)
 register_box(BoxNavigation)
+register_box(BoxRelatedContent)
+register_box(BoxRelatedTags)
 register_box(BoxSectionChildrenToc)
 register_box(BoxTags)
 register_box(ContentBoxSectionChildrenToc)
@@ -57,5 +59,5 @@ ContentBarAware, Repository, Section, SideBarAware, SideBar_View
 Website_BarAware
 # boxes
 BoxContact, BoxFeed, BoxGallery, BoxNavigation, BoxSectionChildrenToc, BoxTags
-ContentBoxSectionChildrenToc, Diaporama, HTMLContent, IdenticaSideBar, MapBox
-MenuSideBar, TwitterSideBar
+BoxRelatedContent, BoxRelatedTags, ContentBoxSectionChildrenToc, Diaporama
+HTMLContent, IdenticaSideBar, MapBox, MenuSideBar, TwitterSideBar
@@ -148,23 +148,15 @@ class BoxFeed_View(Box_View, Details_View):
 
 
     def sort_and_batch(self, resource, context, results):
-        root = context.root
-        user = context.user
-        items = results.get_documents(sort_by=resource.get_property('sort_by'),
+        # The access control is done by the search (see Feed_View.get_items)
+        sort_by = self.get_sort_field(resource, context,
+                                      resource.get_property('sort_by'))
+        items = results.get_documents(sort_by=sort_by,
                                       reverse=resource.get_property('reverse'),
-                                      start=0)
-        # Access Control (FIXME this should be done before batch)
-        allowed_items = []
-        nb_allowed = 0
-        count = resource.get_property('count')
-        for item in items:
-            resource = root.get_resource(item.abspath)
-            ac = resource.get_access_control()
-            if ac.is_allowed_to_view(user, resource):
-                allowed_items.append((item, resource))
-                nb_allowed += 1
-                if nb_allowed == count:
-                    break
+                                      start=0,
+                                      size=resource.get_property('count'))
+        # The resources are loaded by "get_item_resource" when needed
+        allowed_items = [ (item, None) for item in items ]
 
         # FIXME BoxView API
         allowed_to_edit = self.is_admin(resource, context)
@@ -26,7 +26,9 @@ from itools.gettext import MSG
 from base import Box
 from base_views import Box_View
 from itws.datatypes import PositiveInteger
-from itws.tags import TagsAwareClassEnumerate
+from itws.tags import Tag, TagsAware, TagsAwareClassEnumerate
+from itws.catalog import get_link_from_path, select_display_value
+from itws.tags import get_tags_registry
 
 
 
@@ -103,3 +105,157 @@ class BoxTags(Box):
 
     # Views
     view = BoxTags_View()
+
+
+
+class BoxRelatedTags_View(Box_View):
+
+    access = 'is_allowed_to_view'
+    title = MSG(u'View')
+    template = '/ui/bar_items/RelatedTags_view.xml'
+
+
+    def get_related_tags(self, resource, context):
+        """The tags related to the current tag, or to the tags of the
+        current document.
+        """
+        here = context.resource
+        site_root = resource.get_site_root()
+        tags_folder = site_root.get_resource('tags')
+        size = resource.get_property('count')
+        if isinstance(here, Tag):
+            return tags_folder.get_related_tags(context, here.name, size)
+        elif isinstance(here, TagsAware):
+            own_tags = here.get_property('tags')
+            counts = {}
+            for name in own_tags:
+                related = tags_folder.get_related_tags(context, name)
+                for tag, count in related:
+                    if tag not in own_tags:
+                        counts[tag] = counts.get(tag, 0) + count
+            related = sorted(counts.items(), key=lambda x: (-x[1], x[0]))
+            if size:
+                related = related[:size]
+            return related
+        return []
+
+
+    def get_namespace(self, resource, context):
+        title = None
+        if resource.get_property('display_title'):
+            title = resource.get_title()
+
+        registry = get_tags_registry(context, resource.get_site_root())
+        show_number = resource.get_property('show_number')
+        tags = []
+        for name, count in self.get_related_tags(resource, context):
+            tag = registry.tags[name]
+            tag_title = tag['title']
+            if show_number:
+                tag_title = u'%s (%s)' % (tag_title, count)
+            tags.append({'title': tag_title, 'link': tag['href'],
+                         'nb_items': count})
+
+        if not tags and self.is_admin(resource, context) is False:
+            # Hide the box if there is no related tags and
+            # if the user cannot edit the box
+            self.set_view_is_empty(True)
+
+        return {'title': title, 'tags': tags}
+
+
+
+class BoxRelatedTags(Box):
+
+    class_id = 'box-related-tags'
+    class_version = '20110701'
+    class_title = MSG(u'Related tags')
+    class_description = MSG(u'Display the tags found with the current tag, '
+                            u'or with the tags of the current content.')
+    class_icon16 = 'bar_items/icons/16x16/box_tags.png'
+    class_icon48 = 'bar_items/icons/48x48/box_tags.png'
+
+    class_views = ['edit', 'edit_state', 'backlinks', 'commit_log']
+    class_schema = merge_dicts(Box.class_schema,
+            count=PositiveInteger(source='metadata', default=10,
+                      title=MSG(u'Tags to show (0 for all tags)')),
+            show_number=Boolean(source='metadata',
+                title=MSG(u'Show number of items found with each tag')),
+            display_title=Boolean(source='metadata',
+                                  title=MSG(u'Display title')))
+
+    # Configuration
+    allow_instanciation = True
+
+    # Box configuration
+    edit_fields = freeze(['title', 'display_title', 'count', 'show_number'])
+
+    # Views
+    view = BoxRelatedTags_View()
+
+
+
+class BoxRelatedContent_View(Box_View):
+
+    access = 'is_allowed_to_view'
+    title = MSG(u'View')
+    template = '/ui/bar_items/RelatedContent_view.xml'
+
+
+    def get_namespace(self, resource, context):
+        title = None
+        if resource.get_property('display_title'):
+            title = resource.get_title()
+
+        # The documents sharing tags with the current one, from the tags
+        # index (see TagsIndex)
+        here = context.resource
+        items = []
+        if isinstance(here, TagsAware):
+            tags_folder = resource.get_site_root().get_resource('tags')
+            size = resource.get_property('count')
+            documents = tags_folder.get_related_documents(context, here,
+                                                          size)
+            for abspath, values in documents:
+                pub_datetime = context.format_datetime(values['pub_datetime'])
+                item_title = select_display_value(context,
+                                                  values['display_title'])
+                items.append({
+                    'title': item_title or unicode(values['name']),
+                    'link': get_link_from_path(context, abspath),
+                    'pub_datetime': pub_datetime})
+
+        if not items and self.is_admin(resource, context) is False:
+            # Hide the box if there is no related content and
+            # if the user cannot edit the box
+            self.set_view_is_empty(True)
+
+        return {'title': title, 'items': items}
+
+
+
+class BoxRelatedContent(Box):
+
+    class_id = 'box-related-content'
+    class_version = '20110701'
+    class_title = MSG(u'Related content')
+    class_description = MSG(u'Display the contents sharing most tags with '
+                            u'the current webpage, news or section.')
+    class_icon16 = 'bar_items/icons/16x16/box_feed.png'
+    class_icon48 = 'bar_items/icons/48x48/box_feed.png'
+
+    class_views = ['edit', 'edit_state', 'backlinks', 'commit_log']
+    class_schema = merge_dicts(Box.class_schema,
+            count=PositiveInteger(source='metadata', default=5,
+                      title=MSG(u'Number of contents to show')),
+            display_title=Boolean(source='metadata',
+                                  title=MSG(u'Display title')))
+
+    # Configuration
+    allow_instanciation = True
+
+    # Box configuration
+    edit_fields = freeze(['title', 'display_title', 'count'])
+
+    # Views
+    view = BoxRelatedContent_View()
@@ -18,15 +18,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from standard library
-from datetime import datetime
+from datetime import datetime, timedelta
+from threading import Thread
+from time import time
 from traceback import format_exc
-import httplib
 import re
-import socket
-import urllib2
 
 # Import from itools
-from itools import __version__ as itools_version
 from itools.core import freeze, merge_dicts
 from itools.datatypes import Integer, String, XMLContent, Boolean
 from itools.gettext import MSG
@@ -37,40 +35,122 @@ from itools.xml import XMLParser, XMLError
 # Import from itws
 from base import Box
 from base_views import Box_View
+from itws.http_client import http_get, http_head as client_http_head
+from itws.metrics import record_fetch
+from itws.cache import get_data_cache, single_flight
 from itws.utils import ResourceWithCache
 
 
 
 def http_head(hostname, path):
     try:
-        conn = httplib.HTTPConnection(hostname)
-        conn.request("HEAD", path)
-        res = conn.getresponse()
-        conn.close()
-        return res.status == 200
-    except (socket.error, socket.gaierror, Exception,
-            httplib.HTTPException):
+        uri = 'http://%s%s' % (hostname, path)
+        return client_http_head(uri, timeout=3, redirects=0) == 200
+    except Exception:
         return False
-    return False
 
 
-class TwitterID(Integer):
 
-    @staticmethod
-    def is_valid(value):
-        hostname = "twitter.com"
-        path = "/statuses/user_timeline/%s.rss" % value
-        return http_head(hostname, path)
+# How long the existence of an account is known
+account_validation_ttl = timedelta(hours=6)
 
+def get_account_validation(hostname, path):
+    """Return True or False if the account is known to exist or not,
+    None if it has not been checked yet.
+    """
+    key = 'account:%s%s' % (hostname, path)
+    entry = get_data_cache().get(key)
+    if entry is None:
+        return None
+    if datetime.now() - entry['mtime'] > account_validation_ttl:
+        return None
+    return entry['valid']
 
 
-class IndenticaName(String):
+def check_account(hostname, path):
+    key = 'account:%s%s' % (hostname, path)
+    valid = http_head(hostname, path)
+    get_data_cache().set(key, {'mtime': datetime.now(), 'valid': valid})
+    return valid
 
-    @staticmethod
-    def is_valid(value):
-        hostname = "identi.ca"
-        path = "/%s" % value
-        return http_head(hostname, path)
+
+def check_account_in_background(hostname, path):
+    key = 'account:%s%s' % (hostname, path)
+    if not single_flight.begin(key):
+        # Already running
+        return
+
+    def worker():
+        try:
+            check_account(hostname, path)
+        finally:
+            single_flight.end(key)
+
+    thread = Thread(target=worker)
+    thread.setDaemon(True)
+    thread.start()
+
+
+
+class RemoteAccount(object):
+    """An account on a remote host. By default the form accepts any value
+    not known to be invalid and the account is checked in background, the
+    box flags it later if it does not exist.
+    """
+
+    hostname = None
+    async_validation = True
+
+
+    @classmethod
+    def get_account_path(cls, value):
+        raise NotImplementedError
+
+
+    @classmethod
+    def get_validation(cls, value):
+        """Return True, False or None (not checked yet, the check is
+        started in background).
+        """
+        path = cls.get_account_path(value)
+        valid = get_account_validation(cls.hostname, path)
+        if valid is None:
+            check_account_in_background(cls.hostname, path)
+        return valid
+
+
+    @classmethod
+    def is_valid(cls, value):
+        path = cls.get_account_path(value)
+        valid = get_account_validation(cls.hostname, path)
+        if valid is not None:
+            return valid
+        if cls.async_validation:
+            check_account_in_background(cls.hostname, path)
+            return True
+        return check_account(cls.hostname, path)
+
+
+
+class TwitterID(RemoteAccount, Integer):
+
+    hostname = "twitter.com"
+
+
+    @classmethod
+    def get_account_path(cls, value):
+        return "/statuses/user_timeline/%s.rss" % value
+
+
+
+class IndenticaName(RemoteAccount, String):
+
+    hostname = "identi.ca"
+
+
+    @classmethod
+    def get_account_path(cls, value):
+        return "/%s" % value
 
 
 
@@ -94,6 +174,11 @@ class TwitterSideBar_View(Box_View):
         is_allowed_to_edit = ac.is_allowed_to_edit(context.user, resource)
         namespace['items'] = items
         namespace['errors'] = is_allowed_to_edit and errors
+        # The account is checked after the form is saved
+        namespace['invalid_account'] = None
+        if is_allowed_to_edit and resource.is_account_valid() is False:
+            field = resource.account_field
+            namespace['invalid_account'] = resource.get_property(field)
 
         if is_allowed_to_edit is False and (items is None or len(items) == 0):
             self.set_view_is_empty(True)
@@ -132,6 +217,7 @@ class TwitterSideBar(Box, ResourceWithCache):
     # Configuration
     allow_instanciation = True
     edit_fields = freeze(['user_id', 'user_name', 'limit'])
+    account_field = 'user_id'
 
     # Views
     view = TwitterSideBar_View()
@@ -142,6 +228,16 @@ class TwitterSideBar(Box, ResourceWithCache):
         return 'http://twitter.com/statuses/user_timeline/%s.rss' % user_id
 
 
+    def is_account_valid(self):
+        """Return True, False or None if not checked yet.
+        """
+        value = self.get_property(self.account_field)
+        if not value:
+            return None
+        datatype = self.class_schema[self.account_field]
+        return datatype.get_validation(value)
+
+
     def _transform_links(self, item):
         item = item.split(':', 1)[1]
         item = re.sub(r'(\A|\s)@(\w+)',
@@ -167,18 +263,14 @@ class TwitterSideBar(Box, ResourceWithCache):
         errors = []
         errors_str = []
 
-        # backup the default timeout
-        default_timeout = socket.getdefaulttimeout()
-        socket.setdefaulttimeout(3) # timeout in seconds
-
-        # TODO Use itools.vfs instead of urllib2
+        measures = {}
+        fetch_error = None
         try:
-            req = urllib2.Request(uri)
-            req.add_header('User-Agent', 'itools/%s' % itools_version)
-            response = urllib2.urlopen(req)
-            data = response.read()
-        except (socket.error, socket.gaierror, Exception,
-                urllib2.HTTPError, urllib2.URLError), e:
+            response = http_get(uri, timeout=3) # timeout in seconds
+            data = response.data
+            measures = response.timings
+        except Exception, e:
+            fetch_error = e
             msg = '%s -- Network error: "%s"'
             msg = msg % (XMLContent.encode(str(uri)), e)
             msg = msg.encode('utf-8')
@@ -192,9 +284,11 @@ class TwitterSideBar(Box, ResourceWithCache):
         if data:
             # Parse
             feed = None
+            t0 = time()
             try:
                 feed = RSSFile(string=data)
             except Exception, e:
+                fetch_error = e
                 msg = '%s <br />-- Error parsing: "%s"'
                 msg = msg % (XMLContent.encode(str(uri)), e)
                 msg = msg.encode('utf-8')
@@ -204,7 +298,10 @@ class TwitterSideBar(Box, ResourceWithCache):
                 details = format_exc()
                 log_warning(summary + details, domain='itws')
 
+            measures['parse_time'] = time() - t0
+
             if feed:
+                t0 = time()
                 data = []
                 i = 0
                 for item in feed.items:
@@ -224,9 +321,11 @@ class TwitterSideBar(Box, ResourceWithCache):
                         continue
                     else:
                         i += 1
+                measures['sanitize_time'] = time() - t0
+                measures['nb_items'] = len(feed.items)
 
-        # restore the default timeout
-        socket.setdefaulttimeout(default_timeout)
+        record_fetch(self.class_id, self.get_abspath(), uri,
+                     error=fetch_error, **measures)
 
         # errors to display
         list_errors = []
@@ -245,13 +344,12 @@ class TwitterSideBar(Box, ResourceWithCache):
             #list_errors.append(x)
 
         # Save informations only if there is no errors
-        metadata = self.metadata
-        first_update = metadata.cache_mtime is None
-        metadata.cache_mtime = datetime.now()
-        if first_update or (metadata.cache_errors is not None \
-                            and not list_errors):
-            metadata.cache_data = data
-            metadata.cache_errors = list_errors
+        entry = self.get_cache_entry()
+        if entry is None or not list_errors:
+            self.set_cached_data(data, list_errors)
+        else:
+            # Keep the last good data until the next try
+            self.set_cached_data(entry['data'], entry['errors'])
 
 
 
@@ -275,6 +373,7 @@ class IdenticaSideBar(TwitterSideBar):
     allow_instanciation = True
 
     edit_fields = freeze(['user_name', 'limit'])
+    account_field = 'user_name'
 
     # Views
     view = IdenticaSideBar_View()
@@ -0,0 +1,273 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2011 Henry Obein <henry@itaapy.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from cPickle import dump, load, HIGHEST_PROTOCOL
+from collections import OrderedDict
+from hashlib import md5
+from os import getpid, makedirs, remove, rename
+from os.path import exists, join
+from threading import Event, Lock
+from traceback import format_exc
+
+# Import from itools
+from itools.log import log_warning
+
+
+
+class MemoryCache(object):
+    """Cache in the memory of the process, the least recently used entries
+    are dropped beyond a total weight of "size" (every entry weighs 1 by
+    default, see "set").
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.entries = OrderedDict()
+        self.weights = {}
+        self.weight = 0
+        self.lock = Lock()
+
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                # Most recently used
+                self.entries[key] = value
+            return value
+        finally:
+            self.lock.release()
+
+
+    def set(self, key, value, weight=1):
+        self.lock.acquire()
+        try:
+            self._delete(key)
+            if weight > self.size:
+                # Would drop everything else
+                return
+            self.entries[key] = value
+            self.weights[key] = weight
+            self.weight += weight
+            while self.weight > self.size:
+                key, value = self.entries.popitem(last=False)
+                self.weight -= self.weights.pop(key)
+        finally:
+            self.lock.release()
+
+
+    def _delete(self, key):
+        if key in self.entries:
+            del self.entries[key]
+            self.weight -= self.weights.pop(key)
+
+
+    def delete(self, key):
+        self.lock.acquire()
+        try:
+            self._delete(key)
+        finally:
+            self.lock.release()
+
+
+
+class DiskCache(object):
+    """Cache shared by the processes of the server, one pickle file per
+    entry. Any object with the same API (get, set, delete) may be used
+    instead, for example a client of a memcached server.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not exists(path):
+            makedirs(path)
+
+
+    def get_path(self, key):
+        return join(self.path, md5(key).hexdigest())
+
+
+    def get(self, key):
+        path = self.get_path(key)
+        if not exists(path):
+            return None
+        try:
+            cache_file = open(path, 'rb')
+            try:
+                stored_key, value = load(cache_file)
+            finally:
+                cache_file.close()
+        except Exception:
+            summary = 'cache, Error reading cache\npath: %s\n\n' % path
+            log_warning(summary + format_exc(), domain='itws')
+            return None
+        if stored_key != key:
+            return None
+        return value
+
+
+    def set(self, key, value):
+        path = self.get_path(key)
+        tmp_path = '%s.tmp-%s' % (path, getpid())
+        try:
+            cache_file = open(tmp_path, 'wb')
+            try:
+                dump((key, value), cache_file, HIGHEST_PROTOCOL)
+            finally:
+                cache_file.close()
+            # Atomic
+            rename(tmp_path, path)
+        except Exception:
+            summary = 'cache, Error writing cache\npath: %s\n\n' % path
+            log_warning(summary + format_exc(), domain='itws')
+
+
+    def delete(self, key):
+        path = self.get_path(key)
+        if exists(path):
+            remove(path)
+
+
+
+class Cache(object):
+    """A memory cache in front of an optional shared backend.
+    """
+
+    def __init__(self, size=1000, backend=None):
+        self.memory = MemoryCache(size)
+        self.backend = backend
+
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is None and self.backend is not None:
+            value = self.backend.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+        return value
+
+
+    def get_shared(self, key):
+        """Read the entry from the shared backend, it may have been
+        updated by another process.
+        """
+        if self.backend is None:
+            return None
+        value = self.backend.get(key)
+        if value is not None:
+            self.memory.set(key, value)
+        return value
+
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.backend is not None:
+            self.backend.set(key, value)
+
+
+    def delete(self, key):
+        self.memory.delete(key)
+        if self.backend is not None:
+            self.backend.delete(key)
+
+
+
+class SingleFlight(object):
+    """Make sure only one refresh of a given key runs at the same time,
+    the other callers wait for it (a bounded time) or give up.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        # {key: Event}
+        self.flights = {}
+
+
+    def begin(self, key):
+        """Return True if the caller must do the refresh, then it must
+        call "end" when done. Return False if a refresh is running.
+        """
+        self.lock.acquire()
+        try:
+            if key in self.flights:
+                return False
+            self.flights[key] = Event()
+            return True
+        finally:
+            self.lock.release()
+
+
+    def end(self, key):
+        self.lock.acquire()
+        try:
+            event = self.flights.pop(key, None)
+        finally:
+            self.lock.release()
+        if event is not None:
+            event.set()
+
+
+    def is_running(self, key):
+        return key in self.flights
+
+
+    def wait(self, key, timeout=None):
+        """Wait for the running refresh, at most "timeout" seconds. Return
+        True if it is over.
+        """
+        event = self.flights.get(key)
+        if event is None:
+            return True
+        event.wait(timeout)
+        return event.is_set()
+
+
+    def run(self, key, refresh, timeout=None):
+        """Call "refresh" unless another caller is doing it, then wait for
+        it at most "timeout" seconds (0 to not wait). Return True if this
+        call did the refresh.
+        """
+        if not self.begin(key):
+            if timeout != 0:
+                self.wait(key, timeout)
+            return False
+        try:
+            refresh()
+        finally:
+            self.end(key)
+        return True
+
+
+
+single_flight = SingleFlight()
+
+
+
+# The cache of the remote data (Twitter boxes...)
+data_cache = Cache()
+
+def get_data_cache():
+    return data_cache
+
+
+def set_data_cache_backend(backend, size=1000):
+    """Share the cache between the processes, for example with
+    "set_data_cache_backend(DiskCache('<instance>/cache'))".
+    """
+    global data_cache
+    data_cache = Cache(size, backend)
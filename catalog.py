@@ -0,0 +1,552 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2011 Henry Obein <henry@itaapy.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from os import getpid, makedirs, rename, stat
+from os.path import dirname, exists, join
+
+# Import from itools
+from itools.database import AndQuery, NotQuery, OrQuery, PhraseQuery
+from itools.database import register_field
+from itools.datatypes import String, Unicode
+from itools.uri import Path
+from itools.web import get_context
+
+# Import from ikaaro
+from ikaaro.workflow import WorkflowAware
+
+# Import from itws
+from cache import MemoryCache
+
+
+
+###########################################################################
+# View ACL
+###########################################################################
+# Who may see the document, the values used by RoleAware.is_allowed_to_view:
+# "public" for the public documents and the documents without workflow,
+# "private" for the others. The classes the website checks differently
+# (see "view_acl_checked_classes") are indexed "check", they are checked
+# with the access control of the resource. Stored for the indexes kept in
+# memory (see itws.tags.utils.TagsIndex).
+view_acl = String(indexed=True, stored=True, multiple=True)
+register_field('view_acl', view_acl)
+
+
+def get_view_acl(resource):
+    site_root = resource.get_site_root()
+    checked_classes = getattr(site_root, 'view_acl_checked_classes', ())
+    if checked_classes and isinstance(resource, checked_classes):
+        return ['check']
+    if isinstance(resource, WorkflowAware):
+        if resource.get_workflow_state() != 'public':
+            return ['private']
+    return ['public']
+
+
+
+def get_view_acl_values(context):
+    """Return the values of "view_acl" the current user is allowed to see
+    in the current website, None if there is no restriction. The same
+    formula as RoleAware.is_allowed_to_view.
+    """
+    user = context.user
+    site_root = context.resource.get_site_root()
+    ac = site_root.get_access_control()
+    if user is None:
+        role = None
+    elif ac.is_admin(user, site_root):
+        return None
+    else:
+        role = ac.get_user_role(user.name)
+
+    # Intranet
+    if site_root.get_security_policy() == 'intranet':
+        if role in ('admins', 'reviewers', 'members'):
+            return ['public', 'private', 'check']
+        elif role == 'guests':
+            return ['public', 'check']
+        return ['check']
+    # Extranet
+    if role is None:
+        return ['public', 'check']
+    return ['public', 'private', 'check']
+
+
+
+def get_view_acl_class(context):
+    """Return a key shared by the users who see the same documents in the
+    current website, None for the users who see everything.
+    """
+    values = get_view_acl_values(context)
+    if values is None:
+        return None
+    user = context.user
+    if user is None:
+        # The "check" documents are never shown to the anonymous
+        return tuple(values)
+    # The "check" documents depend on the user
+    return tuple(values) + (user.name,)
+
+
+def get_view_acl_query(context):
+    """Return the query of the documents the current user may see in the
+    current website, None if there is no restriction. The documents
+    indexed "check" must be filtered with "filter_view_acl".
+    """
+    values = get_view_acl_values(context)
+    if values is None:
+        return None
+    return OrQuery(*[ PhraseQuery('view_acl', x) for x in values ])
+
+
+def filter_view_acl(context, results):
+    """Remove from the results the documents indexed "check" the current
+    user is not allowed to see.
+    """
+    if get_view_acl_values(context) is None:
+        return results
+
+    user = context.user
+    root = context.root
+    checked = results.search(PhraseQuery('view_acl', 'check'))
+    hidden = []
+    for brain in checked.get_documents():
+        resource = root.get_resource(brain.abspath)
+        ac = resource.get_access_control()
+        if not ac.is_allowed_to_view(user, resource):
+            hidden.append(PhraseQuery('abspath', brain.abspath))
+    if not hidden:
+        return results
+    return results.search(NotQuery(OrQuery(*hidden)))
+
+
+def check_view_acl(context, abspath, view_acl):
+    """Return True if the current user is allowed to see the document of
+    the given path and stored "view_acl" values, without searching.
+    """
+    values = get_view_acl_values(context)
+    if values is None:
+        return True
+    view_acl = view_acl or []
+    if 'check' in view_acl:
+        resource = context.root.get_resource(abspath)
+        ac = resource.get_access_control()
+        return ac.is_allowed_to_view(context.user, resource)
+    for value in view_acl:
+        if value in values:
+            return True
+    return False
+
+
+def search_view_acl(context, results):
+    """Return the documents of the results the current user is allowed to
+    see, for the results not searched with "get_view_acl_query".
+    """
+    acl_query = get_view_acl_query(context)
+    if acl_query is None:
+        return results
+    results = results.search(acl_query)
+    return filter_view_acl(context, results)
+
+
+
+###########################################################################
+# Display values
+###########################################################################
+# The values needed to display the documents in the feed views without
+# loading them. The multilingual values are stored as "<language>:<value>",
+# in the order of the languages of the website.
+register_field('display_title', Unicode(stored=True, multiple=True))
+
+
+def get_display_values(resource, get_value):
+    site_root = resource.get_site_root()
+    values = []
+    for language in site_root.get_property('website_languages'):
+        value = get_value(language)
+        if value:
+            values.append(u'%s:%s' % (language, value))
+    return values
+
+
+def get_display_title(resource):
+    get_value = lambda x: resource.get_property('title', language=x)
+    values = get_display_values(resource, get_value)
+    if values:
+        return values
+    # Fallback to the resource's name
+    site_root = resource.get_site_root()
+    language = site_root.get_property('website_languages')[0]
+    return [u'%s:%s' % (language, resource.name)]
+
+
+def select_display_value(context, values):
+    """Return the value in the language of the user, or in the first
+    language available.
+    """
+    if not values:
+        return None
+    values = [ x.split(':', 1) for x in values ]
+    languages = [ language for language, value in values ]
+    language = context.accept_language.select_language(languages)
+    for key, value in values:
+        if key == language:
+            return value
+    return values[0][1]
+
+
+def get_link_from_path(context, abspath):
+    """Same as "context.get_link" from the path of the resource.
+    """
+    site_root = context.site_root.get_abspath()
+    return '/%s' % site_root.get_pathto(Path(abspath))
+
+
+
+###########################################################################
+# Sort keys
+###########################################################################
+# The sort keys computed when the resources are indexed, so the feed views
+# sort with the catalog. Every key created is indexed {name: SortKey}, the
+# views declare the keys they sort by (see Feed_View.sort_keys).
+indexed_sort_keys = {}
+
+
+class SortKey(object):
+    """The views sorted by "name" use the value of "get_value(resource)",
+    stored in the catalog as "sort_<name>". The multilingual keys use
+    "get_value(resource, language)", stored by language of the website as
+    "sort_<name>_<language>".
+    """
+
+    def __init__(self, name, get_value, datatype=String, multilingual=False):
+        self.name = name
+        self.get_value = get_value
+        self.datatype = datatype
+        self.multilingual = multilingual
+        self.fields = set()
+        indexed_sort_keys[name] = self
+
+
+    def get_field(self, language=None):
+        if self.multilingual:
+            field = 'sort_%s_%s' % (self.name, language)
+        else:
+            field = 'sort_%s' % self.name
+        # The languages are known when the resources are indexed
+        if field not in self.fields:
+            register_field(field, self.datatype(stored=True))
+            self.fields.add(field)
+        return field
+
+
+    def get_catalog_values(self, resource):
+        if not self.multilingual:
+            return {self.get_field(): self.get_value(resource)}
+        site_root = resource.get_site_root()
+        values = {}
+        for language in site_root.get_property('website_languages'):
+            field = self.get_field(language)
+            values[field] = self.get_value(resource, language)
+        return values
+
+
+
+def get_title_sort_value(resource, language):
+    title = resource.get_property('title', language=language)
+    title = title or resource.get_title()
+    return title.lower()
+
+
+# Case insensitive
+title_sort_key = SortKey('title', get_title_sort_value, Unicode,
+                         multilingual=True)
+
+
+
+###########################################################################
+# Search cache
+###########################################################################
+# The results of the searches, by catalog generation: the generation is
+# incremented every time the catalog is committed. The lists are weighed by
+# their length, so the cache keeps at most "size" documents.
+search_cache = MemoryCache(size=50000)
+search_cache_stats = {'generation': 0, 'hits': 0, 'misses': 0}
+
+
+def get_query_key(query):
+    """Return a hashable key of the query, the same for the same query
+    whatever the order of the atoms of AndQuery and OrQuery, or None if the
+    query can not be cached.
+    """
+    if isinstance(query, (AndQuery, OrQuery)):
+        atoms = [ get_query_key(x) for x in query.atoms ]
+        if None in atoms:
+            return None
+        return (query.__class__.__name__, tuple(sorted(atoms)))
+    elif isinstance(query, NotQuery):
+        key = get_query_key(query.query)
+        if key is None:
+            return None
+        return ('NotQuery', key)
+
+    values = []
+    for name, value in sorted(vars(query).items()):
+        if isinstance(value, list):
+            value = tuple(value)
+        try:
+            hash(value)
+        except TypeError:
+            return None
+        values.append((name, value))
+    return (query.__class__.__name__, tuple(values))
+
+
+
+class CachedResults(object):
+    """Same API as the results of "root.search", the number of documents
+    and the batches are kept in the search cache.
+    """
+
+    def __init__(self, root, query):
+        self.root = root
+        self.query = query
+        self.key = get_query_key(query)
+        self.results = None
+
+
+    def get_results(self):
+        if self.results is None:
+            self.results = self.root.search(self.query)
+        return self.results
+
+
+    def get_cached(self, name, get_value):
+        """Return the value computed by "get_value" from the results, kept
+        in the search cache under "name".
+        """
+        if self.key is None:
+            return get_value()
+        generation = (search_cache_stats['generation'],
+                      get_shared_generation())
+        key = (generation, self.key, name)
+        value = search_cache.get(key)
+        if value is None:
+            search_cache_stats['misses'] += 1
+            value = get_value()
+            if isinstance(value, (list, dict)):
+                weight = max(len(value), 1)
+            else:
+                weight = 1
+            search_cache.set(key, value, weight)
+        else:
+            search_cache_stats['hits'] += 1
+        return value
+
+
+    def __len__(self):
+        return self.get_cached('len', lambda: len(self.get_results()))
+
+
+    def get_documents(self, sort_by=None, reverse=False, start=0, size=0):
+        get_documents = self.get_results().get_documents
+        get_value = lambda: list(get_documents(sort_by=sort_by,
+            reverse=reverse, start=start, size=size))
+        name = ('documents', sort_by, reverse, start, size)
+        # A copy, the caller may sort it
+        return list(self.get_cached(name, get_value))
+
+
+    def get_facet_counts(self, name):
+        """Return the number of documents by value of the stored field
+        "name", counted in one pass {value: count}. The tags use their own
+        index (see itws.tags.utils.TagsIndex).
+        """
+        def get_value():
+            counts = {}
+            for document in self.get_results().get_documents():
+                values = getattr(document, name)
+                if values is None:
+                    continue
+                if type(values) is not list:
+                    values = [values]
+                for value in set(values):
+                    counts[value] = counts.get(value, 0) + 1
+            return counts
+        return dict(self.get_cached(('facets', name), get_value))
+
+
+    def search(self, query=None, **kw):
+        queries = [self.query]
+        if query is not None:
+            queries.append(query)
+        for name, value in kw.iteritems():
+            queries.append(PhraseQuery(name, value))
+        return CachedResults(self.root, AndQuery(*queries))
+
+
+    def __getattr__(self, name):
+        return getattr(self.get_results(), name)
+
+
+
+def cached_search(root, query):
+    return CachedResults(root, query)
+
+
+def get_search_cache_stats():
+    stats = dict(search_cache_stats)
+    stats['entries'] = len(search_cache.entries)
+    return stats
+
+
+###########################################################################
+# Generation of the paths
+###########################################################################
+# The generation of a path is incremented every time a document at this
+# path or below is committed to the catalog {path: generation}
+path_generations = {}
+# The documents indexed (their values) or unindexed (None) since the last
+# commit {abspath: values}
+changed_documents = {}
+# Called with the changed documents once they are committed
+index_hooks = []
+
+
+def get_path_generation(path):
+    return path_generations.get(str(path).rstrip('/') or '/', 0)
+
+
+
+# The generations above only count the commits of this process. The
+# commits of the other processes sharing the database (and the read-only
+# workers) are seen through a stamp file, replaced at every commit. When
+# it changes, all the cached results and fragments are obsolete.
+shared_generation = {'stamp': None, 'generation': 0}
+
+
+def get_commit_stamp_path():
+    context = get_context()
+    if context is None or context.database is None:
+        return None
+    instance = dirname(context.database.path.rstrip('/'))
+    return join(instance, 'cache', 'catalog_commit')
+
+
+def get_commit_stamp(path):
+    try:
+        info = stat(path)
+    except OSError:
+        return None
+    return (info.st_ino, info.st_mtime)
+
+
+def get_shared_generation():
+    """Return a number incremented every time another process commits the
+    catalog.
+    """
+    path = get_commit_stamp_path()
+    if path is not None:
+        stamp = get_commit_stamp(path)
+        if stamp != shared_generation['stamp']:
+            shared_generation['stamp'] = stamp
+            shared_generation['generation'] += 1
+    return shared_generation['generation']
+
+
+def write_commit_stamp():
+    path = get_commit_stamp_path()
+    if path is None:
+        return
+    folder = dirname(path)
+    if not exists(folder):
+        makedirs(folder)
+    # A new file, so its inode changes
+    tmp_path = '%s.%s' % (path, getpid())
+    stamp_file = open(tmp_path, 'w')
+    try:
+        stamp_file.write(str(search_cache_stats['generation']))
+    finally:
+        stamp_file.close()
+    rename(tmp_path, path)
+    # Our own commit, the generations of the paths are up to date
+    shared_generation['stamp'] = get_commit_stamp(path)
+
+
+def get_document_value(document, name):
+    if type(document) is dict:
+        return document.get(name)
+    return getattr(document, name, None)
+
+
+def register_index_hook(hook):
+    """Call "hook(documents)" every time the catalog is committed, with the
+    changed documents {abspath: values} (None if unindexed).
+    """
+    index_hooks.append(hook)
+
+
+def document_indexed(document):
+    path = get_document_value(document, 'abspath')
+    if path is not None:
+        changed_documents[str(path)] = document
+
+
+def document_unindexed(abspath):
+    changed_documents[str(abspath)] = None
+
+
+def changes_saved():
+    # The cached results are obsolete
+    search_cache_stats['generation'] += 1
+    # The path and its ancestors
+    ancestors = set(['/'])
+    for path in changed_documents:
+        path = path.rstrip('/')
+        while path:
+            ancestors.add(path)
+            path = path.rsplit('/', 1)[0]
+    for path in ancestors:
+        path_generations[path] = path_generations.get(path, 0) + 1
+    write_commit_stamp()
+    # Update the indexes kept in memory
+    documents = dict(changed_documents)
+    changed_documents.clear()
+    for hook in index_hooks:
+        hook(documents)
+
+
+def changes_aborted():
+    changed_documents.clear()
+
+# See monkey_patch.py for the calls from Catalog
+
+
+
+###########################################################################
+# Catalog values of all the resources
+###########################################################################
+def get_itws_catalog_values(resource):
+    """The values added to the catalog values of every resource (see
+    monkey_patch.py).
+    """
+    values = {}
+    values['view_acl'] = get_view_acl(resource)
+    values['display_title'] = get_display_title(resource)
+    for sort_key in indexed_sort_keys.itervalues():
+        values.update(sort_key.get_catalog_values(resource))
+    return values
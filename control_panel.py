@@ -17,12 +17,16 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+# Import from the Standard Library
+from datetime import datetime
+import json
+
 # Import from itools
 from itools.core import thingy_property
 from itools.datatypes import Boolean
 from itools.gettext import MSG
 from itools.uri import get_reference
-from itools.web import BaseView, get_context
+from itools.web import BaseView, STLView, get_context
 
 # Import from ikaaro
 from ikaaro.cc import SubscribeForm
@@ -33,6 +37,8 @@ from ikaaro.resource_views import DBResource_Links, DBResource_Backlinks
 from ikaaro.revisions_views import DBResource_CommitLog
 
 # Import from itws
+from catalog import get_search_cache_stats
+from metrics import get_fetch_metrics
 from utils import is_navigation_mode
 
 
@@ -225,3 +231,57 @@ class CPFOSwitchMode(BaseView):
             goto = '/'
 
         return get_reference(goto)
+
+
+
+class CPFetchMetrics(STLView):
+
+    access = 'is_allowed_to_edit'
+    title = MSG(u'External data')
+    description = MSG(u'Times, sizes and errors of the downloads of the '
+                      u'external feeds (this process)')
+    itws_icon = 'fetch-metrics.png'
+    template = '/ui/common/fetch_metrics.xml'
+    context_menus = context_menus
+
+
+    def get_namespace(self, resource, context):
+        format_datetime = context.format_datetime
+        sources = []
+        for metrics in get_fetch_metrics(resource.get_abspath()):
+            source = metrics.copy()
+            # Times in milliseconds
+            for name in ('connect_time', 'transfer_time', 'parse_time',
+                         'sanitize_time', 'average_time', 'max_time'):
+                value = metrics[name]
+                if value is not None:
+                    source[name] = int(value * 1000)
+            for name in ('last_fetch', 'last_success', 'last_failure'):
+                value = metrics[name]
+                if value is not None:
+                    source[name] = format_datetime(value)
+            failing = metrics['consecutive_failures'] > 0
+            source['failing'] = failing
+            source['css'] = 'fetch-failing' if failing else None
+            sources.append(source)
+
+        return {'sources': sources,
+                'search_cache': get_search_cache_stats(),
+                'json': '%s/;fetch_metrics_json' % context.get_link(resource)}
+
+
+
+class CPFetchMetrics_JSON(BaseView):
+
+    access = 'is_allowed_to_edit'
+
+
+    def GET(self, resource, context):
+        metrics = get_fetch_metrics(resource.get_abspath())
+        for source in metrics:
+            for name, value in source.items():
+                if isinstance(value, datetime):
+                    source[name] = value.isoformat()
+
+        context.set_content_type('application/json')
+        return json.dumps(metrics)
@@ -16,26 +16,43 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+# Import from the Standard Library
+from types import GeneratorType
+
 # Import from itools
-from itools.core import merge_dicts
+from itools.core import freeze, merge_dicts
 from itools.database import AndQuery, NotQuery, PhraseQuery
 from itools.database import OrQuery, TextQuery
 from itools.datatypes import Integer, String, Boolean
 from itools.gettext import MSG
 from itools.web import FormError
+from itools.xml import XMLParser
 
 # Import from ikaaro
 from ikaaro.buttons import Button
+from ikaaro.file import Image
 from ikaaro.folder_views import Folder_BrowseContent
+from ikaaro.registry import get_resource_class
 from ikaaro.utils import get_base_path_query
 from ikaaro.website import WebSite
-from ikaaro.workflow import get_workflow_preview
+from ikaaro.workflow import WorkflowAware, get_workflow_preview
 
 # Import from itws
+from itws.catalog import cached_search, get_link_from_path
+from itws.catalog import get_path_generation, get_shared_generation
+from itws.catalog import get_view_acl_class
+from itws.catalog import filter_view_acl, get_view_acl_query
+from itws.catalog import select_display_value, title_sort_key
+from itws.cache import MemoryCache
 from itws.utils import ITWS_Autoform, render_for_datatype
 
 
 
+# The rendered content, batch and search form of the feed views
+fragment_cache = MemoryCache(size=500)
+
+
+
 ###########################################
 # See bug:
 # http://bugs.hforge.org/show_bug.cgi?id=1100
@@ -81,7 +98,15 @@ class Feed_View(BrowseContent):
     batch_size = 25
     sort_by = 'title'
     reverse = False
+    # The sorts computed when indexed {sort_by: SortKey}, the others use
+    # the catalog field or the "get_key_sorted_by_<name>" method
+    sort_keys = freeze({'title': title_sort_key})
     more_title = MSG(u'Read more')
+    # Render the values stored in the catalog without loading the resources
+    render_from_brains = True
+    brain_keys = ('class_icon16', 'class_icon48', 'pub_datetime', 'title',
+                  'format', 'long_title', 'link', 'abspath', 'type',
+                  'is_image', 'image', 'tags', 'workflow_state')
     content_keys = ('pub_datetime', 'title', 'long_title',
                     'link', 'is_image', 'preview',
                     'tags', 'workflow_state',
@@ -91,6 +116,9 @@ class Feed_View(BrowseContent):
     # Add an id to a wrapper div based on resource name
     specific_id_wrapper = True
 
+    # Keep the rendered content until the container changes
+    cache_fragments = False
+
     # Search configuration
     search_title = MSG(u'Search')
     search_template = '/ui/feed_views/base_search_template.xml'
@@ -226,6 +254,11 @@ class Feed_View(BrowseContent):
         if search_query:
             queries.extend(search_query)
 
+        # Access Control
+        acl_query = get_view_acl_query(context)
+        if acl_query is not None:
+            queries.append(acl_query)
+
         # Transform list of queries into a query
         if len(queries) == 1:
             query = queries[0]
@@ -233,7 +266,68 @@ class Feed_View(BrowseContent):
             query = AndQuery(*queries)
 
         # Search
-        return root.search(query)
+        results = cached_search(root, query)
+        return filter_view_acl(context, results)
+
+
+    def _get_query_value(self, resource, context, name):
+        # See MultipleFeed_View
+        return context.query[name]
+
+
+    def get_sort_field(self, resource, context, sort_by):
+        """Return the field of the catalog to sort by "sort_by".
+        """
+        sort_key = self.sort_keys.get(sort_by)
+        if sort_key is None:
+            return sort_by
+        # Computed when indexed, by language of the website
+        site_root = resource.get_site_root()
+        languages = site_root.get_property('website_languages')
+        language = context.accept_language.select_language(languages)
+        return sort_key.get_field(language or languages[0])
+
+
+    def sort_and_batch(self, resource, context, results):
+        start = self._get_query_value(resource, context, 'batch_start')
+        size = self._get_query_value(resource, context, 'batch_size')
+        sort_by = self._get_query_value(resource, context, 'sort_by')
+        reverse = self._get_query_value(resource, context, 'reverse')
+
+        if sort_by is None:
+            get_key = None
+        elif sort_by in self.sort_keys:
+            get_key = None
+            sort_by = self.get_sort_field(resource, context, sort_by)
+        else:
+            get_key = getattr(self, 'get_key_sorted_by_' + sort_by, None)
+        if get_key:
+            # Custom but slower sort algorithm
+            items = results.get_documents()
+            items.sort(key=get_key(), reverse=reverse)
+            if size:
+                items = items[start:start+size]
+            elif start:
+                items = items[start:]
+        else:
+            # Faster Xapian sort algorithm
+            items = results.get_documents(sort_by=sort_by, reverse=reverse,
+                                          start=start, size=size)
+
+        # The access control is done by the search (see get_items), the
+        # views searching apart must call itws.catalog.search_view_acl
+        # The resources are loaded by "get_item_resource" when needed
+        return [ (item, None) for item in items ]
+
+
+    def get_item_resource(self, context, item):
+        """Return the resource of the item, the batches only hold the
+        brains (see "sort_and_batch").
+        """
+        item_brain, item_resource = item
+        if item_resource is None:
+            return context.root.get_resource(item_brain.abspath)
+        return item_resource
 
     ###############################################
     ## CSS Class / ID
@@ -258,10 +352,62 @@ class Feed_View(BrowseContent):
         return self.title
 
 
+    def get_fragment_key(self, resource, context):
+        """Return the key of the rendered content in the fragment cache,
+        None to not cache it.
+        """
+        if not self.cache_fragments:
+            return None
+        container = self._get_container(resource, context)
+        site_root = resource.get_site_root()
+        paths = [ x.get_canonical_path() for x in (resource, container) ]
+        # Tags folder (the titles of the tags)
+        paths.append(site_root.get_canonical_path().resolve_name('tags'))
+        paths = [ str(x) for x in paths ]
+        generations = [ get_path_generation(x) for x in paths ]
+        # The commits of the other processes
+        generations.append(get_shared_generation())
+        generations = tuple(generations)
+
+        query = []
+        for name, value in sorted(context.query.items()):
+            if isinstance(value, list):
+                value = tuple(value)
+            query.append((name, value))
+        # The links of the tags keep the query, the links of the batch keep
+        # the whole URI
+        uri = context.uri
+        base_uri = '%s://%s%s' % (uri.scheme, uri.authority, uri.path)
+        uri_query = tuple(sorted(uri.query.items()))
+
+        languages = site_root.get_property('website_languages')
+        language = context.accept_language.select_language(languages)
+
+        cls = self.__class__
+        key = ('%s.%s' % (cls.__module__, cls.__name__), tuple(paths),
+               generations, tuple(query), base_uri, uri_query, language,
+               get_view_acl_class(context))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+
     def get_namespace(self, resource, context):
         self.view_resource = resource
         # Build namespace
-        namespace = BrowseContent.get_namespace(self, resource, context)
+        key = self.get_fragment_key(resource, context)
+        fragments = fragment_cache.get(key) if key is not None else None
+        if fragments is None:
+            fragments = BrowseContent.get_namespace(self, resource, context)
+            if key is not None:
+                # The streams are read again from the cache
+                for name, value in fragments.items():
+                    if isinstance(value, GeneratorType):
+                        fragments[name] = list(value)
+                fragment_cache.set(key, fragments)
+        namespace = dict(fragments)
         namespace['id'] = self.get_css_id(resource, context)
         namespace['css'] = self.get_css(resource, context)
         namespace['title'] = self.get_webpage_title(context)
@@ -329,10 +475,68 @@ class Feed_View(BrowseContent):
         return value
 
 
-    def get_item_value(self, resource, context, item, column):
-        from ikaaro.file import Image
+    def get_brain_value(self, resource, context, brain, column):
+        """Return the value of the column computed from the catalog only.
+        """
+        cls = get_resource_class(brain.format)
+        if column == 'class_icon16':
+            return cls.get_class_icon()
+        elif column == 'class_icon48':
+            return cls.get_class_icon(size='48')
+        elif column == 'pub_datetime':
+            if brain.is_tagsaware and brain.pub_datetime:
+                return context.format_datetime(brain.pub_datetime)
+            return None
+        elif column == 'title':
+            return select_display_value(context, brain.display_title)
+        elif column == 'long_title':
+            if brain.is_tagsaware and brain.display_long_title:
+                return select_display_value(context,
+                                            brain.display_long_title)
+            return select_display_value(context, brain.display_title)
+        elif column in ('link', 'abspath'):
+            return get_link_from_path(context, brain.abspath)
+        elif column in ('format', 'type'):
+            return cls.class_title.gettext()
+        elif column == 'is_image':
+            return issubclass(cls, Image)
+        elif column == 'image':
+            if brain.is_tagsaware:
+                path = select_display_value(context, brain.display_thumbnail)
+                if path:
+                    return get_link_from_path(context, path)
+            elif issubclass(cls, Image):
+                return get_link_from_path(context, brain.abspath)
+            return None
+        elif column == 'tags':
+            if brain.is_tagsaware:
+                # Import here to avoid a circular import
+                from itws.tags import get_tags_registry
+                registry = get_tags_registry(context)
+                return registry.get_tags_namespace(context, brain.tags)
+            return []
+        elif column == 'workflow_state':
+            if not issubclass(cls, WorkflowAware):
+                return None
+            # Same as ikaaro.workflow.get_workflow_preview
+            statename = brain.workflow_state
+            state = cls.workflow.states[statename]
+            msg = state['title'].gettext().encode('utf-8')
+            state = ('<strong class="wf-%s" title="%s">%s</strong>'
+                     % (statename, msg, msg))
+            return XMLParser(state)
+        raise ValueError, column
 
-        item_brain, item_resource = item
+
+    def get_item_value(self, resource, context, item, column):
+        item_brain = item[0]
+        # The brains of a catalog not updated have no display values
+        if (self.render_from_brains and column in self.brain_keys
+                and item_brain.display_title):
+            return self.get_brain_value(resource, context, item_brain,
+                                        column)
+
+        item_resource = self.get_item_resource(context, item)
         if column == 'class_icon16':
             return item_resource.get_class_icon()
         elif column == 'class_icon48':
@@ -385,11 +589,11 @@ class Feed_View(BrowseContent):
             return get_workflow_preview(item_resource, context)
         # We guess from class_schema
         # http://bugs.hforge.org/show_bug.cgi?id=1202
-        schema = item_resource.class_schema
+        schema = get_resource_class(item_brain.format).class_schema
         if schema.has_key(column):
             datatype = schema[column]
             value = self.get_schema_value(item_resource, column, datatype,
                                           item_brain)
             return render_for_datatype(value, datatype, context)
         return BrowseContent.get_item_value(self, resource, context,
-            item, column)
+            (item_brain, item_resource), column)
@@ -104,7 +104,7 @@ class Browse_Navigator(Feed_View):
 
 
     def get_item_value(self, resource, context, item, column):
-        item_brain, item_resource = item
+        item_resource = self.get_item_resource(context, item)
         if column == 'title':
             title = item_resource.get_title()
             if isinstance(item_resource, Folder):
@@ -81,43 +81,6 @@ class MultipleFeed_View(Feed_View):
         return prefixed_d
 
 
-    def sort_and_batch(self, resource, context, results):
-        user = context.user
-        root = context.root
-
-        start = self._get_query_value(resource, context, 'batch_start')
-        size = self._get_query_value(resource, context, 'batch_size')
-        sort_by = self._get_query_value(resource, context, 'sort_by')
-        reverse = self._get_query_value(resource, context, 'reverse')
-
-        if sort_by is None:
-            get_key = None
-        else:
-            get_key = getattr(self, 'get_key_sorted_by_' + sort_by, None)
-        if get_key:
-            # Custom but slower sort algorithm
-            items = results.get_documents()
-            items.sort(key=get_key(), reverse=reverse)
-            if size:
-                items = items[start:start+size]
-            elif start:
-                items = items[start:]
-        else:
-            # Faster Xapian sort algorithm
-            items = results.get_documents(sort_by=sort_by, reverse=reverse,
-                                          start=start, size=size)
-
-        # Access Control (FIXME this should be done before batch)
-        allowed_items = []
-        for item in items:
-            resource = root.get_resource(item.abspath)
-            ac = resource.get_access_control()
-            if ac.is_allowed_to_view(user, resource):
-                allowed_items.append((item, resource))
-
-        return allowed_items
-
-
     def get_batch_namespace(self, resource, context, items):
         if self.show_first_batch is False and self.show_second_batch is False:
             return None
@@ -0,0 +1,304 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2011 Henry Obein <henry@itaapy.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from base64 import b64encode
+from threading import Lock
+from time import time
+from urllib import getproxies, proxy_bypass, unquote
+from urlparse import urljoin, urlsplit
+from zlib import decompressobj, MAX_WBITS
+import httplib
+import socket
+import ssl
+
+# Import from itools
+from itools import __version__ as itools_version
+
+
+# HTTP client for the external data (aggregated feeds, Twitter boxes,
+# validators). The connections are kept alive and reused, every call has
+# its own timeout, so the default timeout of the process is never changed.
+# The proxies of the environment are honoured, like urllib2 did.
+
+user_agent = 'itools/%s' % itools_version
+
+# Defaults
+default_timeout = 10
+default_max_size = 5 * 1024 * 1024
+max_redirects = 5
+
+# Number of idle connections kept by host
+pool_size = 4
+# Seconds an idle connection is kept, the servers close them anyway
+max_idle = 30
+
+# The idle connections
+# {(scheme, host, port, proxy): [(connection, time), ...]}
+pool = {}
+pool_lock = Lock()
+
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, uri):
+        Exception.__init__(self, 'HTTP Error %s: %s' % (status, uri))
+        self.status = status
+        self.uri = uri
+
+
+
+class ResponseTooLarge(Exception):
+    pass
+
+
+
+class Response(object):
+
+    def __init__(self, uri, status, headers, data, timings):
+        self.uri = uri
+        self.status = status
+        # The names of the headers are in lower case
+        self.headers = headers
+        self.data = data
+        self.timings = timings
+
+
+
+def get_proxy(scheme, host):
+    """Return the proxy to reach the host as (host, port, headers), from
+    the environment (http_proxy, https_proxy, no_proxy) like urllib2, or
+    None.
+    """
+    proxy = getproxies().get(scheme)
+    if not proxy or proxy_bypass(host):
+        return None
+    if '://' not in proxy:
+        proxy = 'http://%s' % proxy
+    url = urlsplit(proxy)
+    headers = {}
+    if url.username:
+        credentials = '%s:%s' % (unquote(url.username),
+                                 unquote(url.password or ''))
+        credentials = b64encode(credentials)
+        headers['Proxy-Authorization'] = 'Basic %s' % credentials
+    return url.hostname, url.port or 80, headers
+
+
+
+def get_connection(scheme, host, port, proxy, timeout, timings):
+    """Return an idle connection to the host (through the proxy), or a new
+    one.
+    """
+    key = (scheme, host, port, proxy and proxy[:2])
+    conn = None
+    expired = []
+    pool_lock.acquire()
+    try:
+        connections = pool.get(key)
+        while connections:
+            conn, released = connections.pop()
+            if time() - released <= max_idle:
+                break
+            expired.append(conn)
+            conn = None
+    finally:
+        pool_lock.release()
+    for old_conn in expired:
+        old_conn.close()
+    if conn is not None:
+        conn.sock.settimeout(timeout)
+        timings['connect_time'] = 0.0
+        return conn, True
+
+    # The connect time includes the DNS resolution
+    if proxy is None:
+        address = (host, port)
+    else:
+        address = proxy[:2]
+    if scheme == 'https':
+        context = ssl.create_default_context()
+        conn = httplib.HTTPSConnection(address[0], address[1],
+                                       timeout=timeout, context=context)
+        if proxy is not None:
+            conn.set_tunnel(host, port, proxy[2])
+    else:
+        conn = httplib.HTTPConnection(address[0], address[1],
+                                      timeout=timeout)
+    t0 = time()
+    try:
+        conn.connect()
+    except Exception:
+        conn.close()
+        raise
+    timings['connect_time'] = time() - t0
+    return conn, False
+
+
+
+def release_connection(scheme, host, port, proxy, conn):
+    key = (scheme, host, port, proxy and proxy[:2])
+    pool_lock.acquire()
+    try:
+        connections = pool.setdefault(key, [])
+        if len(connections) < pool_size:
+            connections.append((conn, time()))
+            return
+    finally:
+        pool_lock.release()
+    conn.close()
+
+
+
+def read_body(response, max_size):
+    """Read the body, decompressed if needed. Raise ResponseTooLarge if it
+    is bigger than "max_size".
+    """
+    decompress = None
+    if response.getheader('content-encoding', '').lower() == 'gzip':
+        decompress = decompressobj(16 + MAX_WBITS)
+
+    too_large = 'more than %s bytes' % max_size
+    size = 0
+    chunks = []
+    while True:
+        chunk = response.read(65536)
+        if not chunk:
+            break
+        if decompress is not None:
+            if max_size:
+                # Never inflate more than the allowed size
+                chunk = decompress.decompress(chunk, max_size - size + 1)
+                if decompress.unconsumed_tail:
+                    raise ResponseTooLarge(too_large)
+            else:
+                chunk = decompress.decompress(chunk)
+        size += len(chunk)
+        if max_size and size > max_size:
+            raise ResponseTooLarge(too_large)
+        chunks.append(chunk)
+    if decompress is not None:
+        chunk = decompress.flush()
+        size += len(chunk)
+        if max_size and size > max_size:
+            raise ResponseTooLarge(too_large)
+        chunks.append(chunk)
+    return ''.join(chunks)
+
+
+
+def _request(method, uri, headers, timeout, max_size):
+    url = urlsplit(uri)
+    scheme = url.scheme.lower()
+    if scheme not in ('http', 'https'):
+        raise ValueError('unsupported scheme "%s"' % scheme)
+    host = url.hostname
+    port = url.port or (443 if scheme == 'https' else 80)
+    path = url.path or '/'
+    if url.query:
+        path = '%s?%s' % (path, url.query)
+
+    request_headers = {'User-Agent': user_agent,
+                       'Accept-Encoding': 'gzip'}
+    proxy = get_proxy(scheme, host)
+    if proxy is not None and scheme == 'http':
+        # The plain requests go to the proxy with the absolute URI
+        path = '%s://%s:%s%s' % (scheme, host, port, path)
+        request_headers.update(proxy[2])
+    if headers:
+        request_headers.update(headers)
+    timings = {}
+    conn, reused = get_connection(scheme, host, port, proxy, timeout,
+                                  timings)
+    t0 = time()
+    try:
+        try:
+            conn.request(method, path, headers=request_headers)
+            response = conn.getresponse()
+        except (httplib.BadStatusLine, socket.error):
+            if not reused:
+                raise
+            # The server closed the idle connection, try a new one
+            conn.close()
+            conn, reused = get_connection(scheme, host, port, proxy,
+                                          timeout, timings)
+            t0 = time()
+            conn.request(method, path, headers=request_headers)
+            response = conn.getresponse()
+        if method == 'HEAD':
+            data = response.read()
+        else:
+            data = read_body(response, max_size)
+    except Exception:
+        conn.close()
+        raise
+    timings['transfer_time'] = time() - t0
+    timings['bytes'] = len(data)
+    timings['status'] = response.status
+
+    # Keep alive
+    if response.will_close:
+        conn.close()
+    else:
+        release_connection(scheme, host, port, proxy, conn)
+
+    headers = dict(response.getheaders())
+    return Response(uri, response.status, headers, data, timings)
+
+
+
+def http_request(method, uri, headers=None, timeout=default_timeout,
+                 max_size=default_max_size, redirects=max_redirects):
+    """Send the request and return the Response, following at most
+    "redirects" redirections. The times of the redirections are added up.
+    """
+    timings = {}
+    for i in range(redirects + 1):
+        response = _request(method, uri, headers, timeout, max_size)
+        for name, value in response.timings.iteritems():
+            if name.endswith('_time'):
+                value += timings.get(name, 0.0)
+            timings[name] = value
+        response.timings = timings
+        location = response.headers.get('location')
+        if response.status not in (301, 302, 303, 307) or not location:
+            return response
+        uri = urljoin(uri, location)
+        if response.status == 303:
+            method = 'GET'
+    return response
+
+
+
+def http_get(uri, headers=None, timeout=default_timeout,
+             max_size=default_max_size):
+    """Return the Response of a GET, raise HTTPError if the status is not
+    a success (or 304, for conditional requests).
+    """
+    response = http_request('GET', uri, headers, timeout, max_size)
+    if response.status != 304 and not (200 <= response.status < 300):
+        raise HTTPError(response.status, uri)
+    return response
+
+
+
+def http_head(uri, headers=None, timeout=default_timeout,
+              redirects=max_redirects):
+    """Return the HTTP status of a HEAD request.
+    """
+    return http_request('HEAD', uri, headers, timeout,
+                        redirects=redirects).status
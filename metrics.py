@@ -0,0 +1,97 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2011 Henry Obein <henry@itaapy.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from datetime import datetime
+from threading import Lock
+
+
+# Metrics of the fetches of external data (aggregated feeds, Twitter and
+# Identi.ca boxes...), kept in memory by every process.
+
+# The measures recorded for every fetch
+fetch_measures = ['connect_time', 'transfer_time', 'bytes', 'status',
+                  'parse_time', 'sanitize_time', 'nb_items']
+
+# Number of durations kept to compute the average
+history_size = 20
+
+# {(source, resource path, uri): metrics}
+fetch_metrics = {}
+fetch_metrics_lock = Lock()
+
+
+
+def record_fetch(source, path, uri, error=None, **measures):
+    """Record the result of a fetch of "uri" for the resource at "path".
+    The error is None on success.
+    """
+    key = (source, str(path), str(uri))
+    now = datetime.now()
+    fetch_metrics_lock.acquire()
+    try:
+        metrics = fetch_metrics.get(key)
+        if metrics is None:
+            metrics = fetch_metrics[key] = {
+                'source': source, 'path': key[1], 'uri': key[2],
+                'nb_fetches': 0, 'nb_failures': 0,
+                'consecutive_failures': 0, 'last_fetch': None,
+                'last_success': None, 'last_failure': None,
+                'last_error': None, 'durations': []}
+        for name in fetch_measures:
+            metrics[name] = measures.get(name)
+        metrics['nb_fetches'] += 1
+        metrics['last_fetch'] = now
+        if error is None:
+            metrics['consecutive_failures'] = 0
+            metrics['last_success'] = now
+        else:
+            metrics['nb_failures'] += 1
+            metrics['consecutive_failures'] += 1
+            metrics['last_failure'] = now
+            metrics['last_error'] = str(error)
+        duration = sum([ measures.get(x) or 0
+                         for x in ('connect_time', 'transfer_time') ])
+        durations = metrics['durations']
+        durations.append(duration)
+        del durations[:-history_size]
+    finally:
+        fetch_metrics_lock.release()
+
+
+
+def get_fetch_metrics(path=None):
+    """Return a copy of the metrics of the resources in "path" (or all),
+    with the average and maximum fetch duration.
+    """
+    if path is not None:
+        path = str(path).rstrip('/') + '/'
+    results = []
+    fetch_metrics_lock.acquire()
+    try:
+        for key, metrics in fetch_metrics.iteritems():
+            if path is not None and not (key[1] + '/').startswith(path):
+                continue
+            metrics = metrics.copy()
+            durations = metrics.pop('durations')
+            metrics['average_time'] = sum(durations) / len(durations)
+            metrics['max_time'] = max(durations)
+            results.append(metrics)
+    finally:
+        fetch_metrics_lock.release()
+
+    results.sort(key=lambda x: (x['source'], x['path'], x['uri']))
+    return results
@@ -15,6 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from itools
+from itools.database import Catalog
 from itools.gettext import MSG
 
 # Import from ikaaro
@@ -25,6 +26,7 @@ from ikaaro.folder import Folder
 from ikaaro.folder_views import Folder_BrowseContent
 from ikaaro.menu import Menu_View
 from ikaaro.registry import resources_registry
+from ikaaro.resource_ import DBResource
 from ikaaro.resource_views import DBResource_Edit
 from ikaaro.revisions_views import DBResource_CommitLog, DBResource_Changes
 from ikaaro.root import Root
@@ -33,6 +35,8 @@ from ikaaro.tracker import Tracker
 from ikaaro.views_new import NewInstance
 
 # Import from itws
+from catalog import changes_aborted, changes_saved, document_indexed
+from catalog import document_unindexed, get_itws_catalog_values
 from feed_views import Browse_Navigator, Browse_Navigator_Rename
 from itws.control_panel import CPDBResource_Backlinks, CPDBResource_CommitLog
 from itws.control_panel import CPExternalEdit, CPDBResource_Links
@@ -115,3 +119,36 @@ for cls in resources_registry.values():
     cls.add_link = ITWS_DBResource_AddLink()
     cls.add_media = ITWS_DBResource_AddMedia()
 
+
+# Keep the caches of the catalog up to date (see itws.catalog)
+_index_document = Catalog.index_document
+def index_document(self, document):
+    _index_document(self, document)
+    document_indexed(document)
+Catalog.index_document = index_document
+
+_unindex_document = Catalog.unindex_document
+def unindex_document(self, abspath):
+    _unindex_document(self, abspath)
+    document_unindexed(abspath)
+Catalog.unindex_document = unindex_document
+
+_save_changes = Catalog.save_changes
+def save_changes(self):
+    _save_changes(self)
+    changes_saved()
+Catalog.save_changes = save_changes
+
+_abort_changes = Catalog.abort_changes
+def abort_changes(self):
+    _abort_changes(self)
+    changes_aborted()
+Catalog.abort_changes = abort_changes
+
+# Values used by the feed views (access control, display, sort)
+_get_catalog_values = DBResource.get_catalog_values
+def get_catalog_values(self):
+    values = _get_catalog_values(self)
+    values.update(get_itws_catalog_values(self))
+    return values
+DBResource.get_catalog_values = get_catalog_values
@@ -102,6 +102,7 @@ class NewsFolder_View(Details_View):
     search_template = None
     sort_by = 'pub_datetime'
     reverse = True
+    cache_fragments = True
 
     # Display sidebar
     display_sidebar = True
@@ -138,7 +139,8 @@ class NewsFolder_View(Details_View):
 class NewsFolder_RSS(BaseRSS):
 
     def get_base_query(self, resource, context):
-        today = datetime.now()
+        # To the minute, so the query is the same (see cached_search)
+        today = datetime.now().replace(second=0, microsecond=0)
         min_date = datetime(1900, 1, 1)
         # Filter by news folder
         abspath = resource.get_canonical_path()
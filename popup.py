@@ -28,6 +28,7 @@ from ikaaro.popup import DBResource_AddImage, AddBase_BrowseContent
 from ikaaro.utils import get_base_path_query
 
 # Import from itws
+from itws.catalog import search_view_acl
 from itws.datatypes import SortBy_Enumerate, Reverse_Enumerate
 from itws.feed_views import Feed_View
 
@@ -48,7 +49,8 @@ def get_itws_namespace(cls, self, resource, context):
 
 
 def itws_get_item_value(self, resource, context, item, column):
-    brain, item_resource = item
+    brain = item[0]
+    item_resource = self.get_item_resource(context, item)
     if column == 'js_link':
         id = str(resource.get_canonical_path().get_pathto(brain.abspath))
         id += self.resource_action
@@ -144,7 +146,10 @@ class ITWS_AddBase_BrowseContent(Feed_View, AddBase_BrowseContent):
         target = self._get_target(resource, context)
         args = list(args)
         args.extend(itws_get_additional_args(self.target))
-        return AddBase_BrowseContent.get_items(self, target, context, *args)
+        proxy = AddBase_BrowseContent
+        results = proxy.get_items(self, target, context, *args)
+        # Feed_View.sort_and_batch does not check the access control
+        return search_view_acl(context, results)
 
 
     def get_table_namespace(self, resource, context, items):
@@ -167,7 +172,10 @@ class ITWS_AddMedia_BrowseContent(Feed_View, AddMedia_BrowseContent):
     def get_items(self, resource, context, *args):
         args = list(args)
         args.extend(itws_get_additional_args(self.target))
-        return AddMedia_BrowseContent.get_items(self, resource, context, *args)
+        proxy = AddMedia_BrowseContent
+        results = proxy.get_items(self, resource, context, *args)
+        # Feed_View.sort_and_batch does not check the access control
+        return search_view_acl(context, results)
 
 
     def get_table_namespace(self, resource, context, items):
@@ -191,7 +199,10 @@ class ITWS_AddImage_BrowseContent(Feed_View, AddImage_BrowseContent):
     def get_items(self, resource, context, *args):
         args = list(args)
         args.extend(itws_get_additional_args(self.target))
-        return AddImage_BrowseContent.get_items(self, resource, context, *args)
+        proxy = AddImage_BrowseContent
+        results = proxy.get_items(self, resource, context, *args)
+        # Feed_View.sort_and_batch does not check the access control
+        return search_view_acl(context, results)
 
 
     def get_table_namespace(self, resource, context, items):
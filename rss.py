@@ -32,6 +32,9 @@ from itools.web import BaseView, get_context
 from ikaaro.utils import get_base_path_query
 from ikaaro.webpage import WebPage
 
+# Import from itws
+from catalog import cached_search, filter_view_acl, get_view_acl_query
+
 
 
 class BaseRSS(BaseView):
@@ -50,11 +53,16 @@ class BaseRSS(BaseView):
         query = [ get_base_path_query(str(abspath)),
                   PhraseQuery('is_content', True) ]
         # Filter by pub_datetime
-        today = datetime.now()
+        # To the minute, so the query is the same (see cached_search)
+        today = datetime.now().replace(second=0, microsecond=0)
         min_date = datetime(1900, 1, 1)
         query.append(RangeQuery('pub_datetime', min_date, today))
         # Do not show image
         query.append(PhraseQuery('is_image', False))
+        # Access Control
+        acl_query = get_view_acl_query(context)
+        if acl_query is not None:
+            query.append(acl_query)
         return query
 
 
@@ -138,7 +146,8 @@ class BaseRSS(BaseView):
             query.append(query2)
 
         query = AndQuery(*query)
-        return resource.get_root().search(query)
+        results = cached_search(resource.get_root(), query)
+        return filter_view_acl(context, results)
 
 
     def _sort_and_batch(self, resource, context, results):
@@ -151,18 +160,9 @@ class BaseRSS(BaseView):
     def sort_and_batch(self, resource, context, results):
         items = self._sort_and_batch(resource, context, results)
 
-        # Access Control (FIXME this should be done before batch)
-        user = context.user
+        # The access control is done by the search (see get_base_query)
         root = context.root
-        allowed_items = []
-        for item in items:
-            abspath = item.abspath
-            resource = root.get_resource(abspath)
-            ac = resource.get_access_control()
-            if ac.is_allowed_to_view(user, resource):
-                allowed_items.append((item, resource))
-
-        return allowed_items
+        return [ (item, root.get_resource(item.abspath)) for item in items ]
 
 
     def get_mtime(self, resource):
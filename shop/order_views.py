@@ -34,6 +34,7 @@ from ikaaro.utils import CMSTemplate, get_base_path_query
 from ikaaro.views import CompositeForm, CompositeView
 
 # Import from itws
+from itws.catalog import search_view_acl
 from itws.views import FieldsAdvance_NewInstance
 from itws.feed_views import TableFeed_View, FieldsTableFeed_View
 from itws.utils import bool_to_img
@@ -85,7 +86,7 @@ class Order_ViewBills(FieldsTableFeed_View):
 
     def get_item_value(self, resource, context, item, column):
         if column == 'title':
-            brain, item_resource = item
+            item_resource = self.get_item_resource(context, item)
             title = item_resource.get_property('title')
             link = context.get_link(item_resource)
             return title, '%s/;download' % link
@@ -121,11 +122,14 @@ class Order_ViewPayments(TableFeed_View):
 
 
     def get_items(self, resource, context):
-        return resource.get_payments(as_results=True)
+        results = resource.get_payments(as_results=True)
+        # Feed_View.sort_and_batch does not check the access control
+        return search_view_acl(context, results)
 
 
     def get_item_value(self, resource, context, item, column):
-        brain, item_resource = item
+        brain = item[0]
+        item_resource = self.get_item_resource(context, item)
         if column == 'reference':
             if self.admin_view is False:
                 return brain.name
@@ -419,7 +423,8 @@ class OrderModule_ViewOrders(FieldsTableFeed_View):
                     'total_price', 'total_paid', 'ctime', 'bill']
 
     def get_item_value(self, resource, context, item, column):
-        brain, item_resource = item
+        brain = item[0]
+        item_resource = self.get_item_resource(context, item)
         if column in ('total_price', 'total_paid'):
             value = item_resource.get_property(column)
             return item_resource.format_price(value)
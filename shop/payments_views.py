@@ -31,6 +31,7 @@ from payment_way import PaymentWay
 from widgets import PaymentWays_Widget
 from itws.shop.devises import Devises
 from itws.enumerates import DynamicEnumerate
+from itws.catalog import search_view_acl
 from itws.feed_views import FieldsTableFeed_View
 
 
@@ -60,11 +61,14 @@ class PaymentModule_View(FieldsTableFeed_View):
 
 
     def get_items(self, resource, context):
-        return resource.get_payment_ways(as_results=True)
+        results = resource.get_payment_ways(as_results=True)
+        # Feed_View.sort_and_batch does not check the access control
+        return search_view_acl(context, results)
 
 
     def get_item_value(self, resource, context, item, column):
-        brain, item_resource = item
+        brain = item[0]
+        item_resource = self.get_item_resource(context, item)
         if column == 'logo':
             logo = item_resource.get_property('logo')
             if logo:
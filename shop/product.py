@@ -95,7 +95,7 @@ class Products_View(FieldsTableFeed_View):
 
 
     def get_item_value(self, resource, context, item, column):
-        item_brain, item_resource = item
+        item_resource = self.get_item_resource(context, item)
         if column == 'reference':
             return item_resource.get_property('reference')
         elif column == 'title':
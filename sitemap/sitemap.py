@@ -29,6 +29,9 @@ from itools.database import AndQuery, OrQuery, PhraseQuery
 from ikaaro.folder import Folder
 from ikaaro.utils import get_base_path_query
 
+# Import from itws
+from itws.catalog import cached_search
+
 
 
 class SiteMapView(BaseView):
@@ -56,8 +59,7 @@ class SiteMapView(BaseView):
     def get_items(self, resource, context):
         # items are brains
         query = self.get_items_query(resource, context)
-        root = context.root
-        results = root.search(query)
+        results = cached_search(context.root, query)
         return results.get_documents(sort_by='abspath')
 
 
@@ -84,7 +86,7 @@ class SiteMapView(BaseView):
         sitemaps = []
 
         query = self.get_items_query(resource, context)
-        items = context.root.search(query)
+        items = cached_search(context.root, query)
 
         nb_items = len(items)
         id_sitemap = context.query['id']
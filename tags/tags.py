@@ -17,10 +17,13 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+# Import from the Standard Library
+from datetime import datetime
+
 # Import from itools
 from itools.datatypes import Boolean, DateTime, String, Unicode, URI
 from itools.gettext import MSG
-from itools.uri import Path, encode_query, get_reference
+from itools.uri import Path, get_reference
 from itools.web import get_context
 from itools.database import AndQuery, PhraseQuery, OrQuery
 
@@ -40,6 +43,8 @@ from ikaaro.views_new import NewInstance
 from datatypes import TagsList
 from tags_views import Tag_View, Tag_Edit, Tag_RSS, TagsFolder_TagCloud
 from tags_views import TagsFolder_BrowseContent
+from utils import get_tags_index, get_tags_registry, get_utc_datetime
+from itws.catalog import cached_search, check_view_acl, get_display_values
 from itws.widgets import DualSelectWidget, JSDatetimeWidget
 
 
@@ -149,20 +154,68 @@ class TagsFolder(Folder):
         return query
 
 
-    def is_empty(self, context):
-        all_tags_aware_query = self.get_tags_query_terms(state='public')
-        all_tags_aware_query = AndQuery(*all_tags_aware_query)
+    def get_tags_counts(self, context, state=None, formats=[]):
+        """Return the number of tagged documents of the website by tag
+        {name: count}, kept up to date by the catalog (see TagsIndex).
+        """
+        index = get_tags_index(context.root, self.get_site_root())
+        return index.get_counts(state=state, formats=formats)
 
-        # tags
-        tag_brains = self.get_tag_brains(context)
 
-        # all tags
-        all_tags_aware_results = context.root.search(all_tags_aware_query)
-        query = [  PhraseQuery('tags', brain.name)
-                   for brain in tag_brains ]
-        results = all_tags_aware_results.search(OrQuery(*query))
+    def get_related_tags(self, context, name, size=0):
+        """Return the tags the user can see, found with the given tag in the
+        public documents, the most frequent first [(name, count), ...].
+        """
+        index = get_tags_index(context.root, self.get_site_root())
+        related = index.get_cooccurrences(name)
+
+        registry = get_tags_registry(context, self.get_site_root())
+        tags = []
+        for tag, count in related:
+            if registry.is_visible(tag):
+                tags.append((tag, count))
+                if len(tags) == size:
+                    break
+        return tags
 
-        return len(results) == 0
+
+    def get_related_documents(self, context, resource, size=5):
+        """Return the public and published documents the user can see,
+        sharing most tags with the given resource [(abspath, values), ...],
+        see TagsIndex for the values.
+        """
+        index = get_tags_index(context.root, self.get_site_root())
+        abspath = str(resource.get_canonical_path())
+        now = datetime.utcnow()
+        documents = []
+        for path in index.get_neighbours(abspath):
+            values = index.documents[path]
+            pub_datetime = values['pub_datetime']
+            if pub_datetime is None:
+                continue
+            if pub_datetime.utcoffset() is None:
+                # Local time
+                if pub_datetime > datetime.now():
+                    continue
+            elif get_utc_datetime(pub_datetime) > now:
+                continue
+            if not check_view_acl(context, path, values['view_acl']):
+                continue
+            documents.append((path, values))
+            if len(documents) == size:
+                break
+        return documents
+
+
+    def is_empty(self, context):
+        # The public documents tagged by a public tag
+        counts = self.get_tags_counts(context, state='public')
+        if not counts:
+            return True
+        for brain in self.get_tag_brains(context):
+            if counts.get(brain.name):
+                return False
+        return True
 
 
     def get_tag_brains(self, context, sort_by='name', size=0, states=['public']):
@@ -179,9 +232,8 @@ class TagsFolder(Folder):
             else:
                 tags_query.append(OrQuery(*workflow_query))
         tags_query = AndQuery(*tags_query)
-        tags_results = context.root.search(tags_query)
-        documents = tags_results.get_documents(sort_by=sort_by, size=size)
-        return [ x for x in documents ]
+        tags_results = cached_search(context.root, tags_query)
+        return tags_results.get_documents(sort_by=sort_by, size=size)
 
 
 
@@ -202,6 +254,9 @@ class TagsAware(object):
             # Catalog
             'is_tagsaware': Boolean(indexed=True, stored=True),
             'preview_content': Unicode(stored=True, indexed=True),
+            # Catalog, to display without loading (see itws.catalog)
+            'display_long_title': Unicode(stored=True, multiple=True),
+            'display_thumbnail': String(stored=True, multiple=True),
             }
 
 
@@ -210,6 +265,13 @@ class TagsAware(object):
         indexes['pub_datetime'] = self.get_property('pub_datetime')
         indexes['is_tagsaware'] = True
         indexes['preview_content'] = self.get_preview_content()
+        # Display values
+        if 'long_title' in self.class_schema:
+            get_value = lambda x: self.get_property('long_title', language=x)
+            indexes['display_long_title'] = get_display_values(self,
+                                                               get_value)
+        get_value = lambda x: self.get_preview_thumbnail_path(language=x)
+        indexes['display_thumbnail'] = get_display_values(self, get_value)
         return indexes
 
     ##########################################################################
@@ -217,22 +279,8 @@ class TagsAware(object):
     ##########################################################################
 
     def get_tags_namespace(self, context):
-        tags_folder = self.get_site_root().get_resource('tags')
-        ac = tags_folder.get_access_control()
-        # query
-        query = encode_query(context.uri.query)
-
-        tags = []
-        for tag_name in self.get_property('tags'):
-            tag = tags_folder.get_resource(tag_name)
-            # Check ACL
-            if ac.is_allowed_to_view(context.user, tag) is False:
-                continue
-            href = context.get_link(tag)
-            if query:
-                href = '%s?%s' % (href, query)
-            tags.append({'title': tag.get_title(), 'href': href})
-        return tags
+        registry = get_tags_registry(context, self.get_site_root())
+        return registry.get_tags_namespace(context, self.get_property('tags'))
 
 
     def get_pub_datetime(self):
@@ -300,8 +348,8 @@ class TagsAware(object):
         return result
 
 
-    def get_preview_thumbnail(self):
-        path = self.get_property('thumbnail')
+    def get_preview_thumbnail(self, language=None):
+        path = self.get_property('thumbnail', language=language)
         if not path:
             return None
         ref = get_reference(path)
@@ -310,6 +358,13 @@ class TagsAware(object):
         return self.get_resource(path, soft=True)
 
 
+    def get_preview_thumbnail_path(self, language=None):
+        thumbnail = self.get_preview_thumbnail(language)
+        if thumbnail is None:
+            return None
+        return str(thumbnail.get_abspath())
+
+
     ##########################################################################
     # Links API
     ##########################################################################
@@ -29,7 +29,7 @@ from itools.html import stream_to_str_as_xhtml
 from itools.stl import set_prefix
 from itools.uri import encode_query
 from itools.web import get_context, STLView
-from itools.database import AndQuery, PhraseQuery
+from itools.database import AndQuery
 
 # Import from ikaaro
 from ikaaro.file_views import File_Edit
@@ -42,6 +42,7 @@ from ikaaro.workflow import state_widget
 from itws.feed_views import Details_View
 from itws.rss import BaseRSS
 from itws.utils import is_navigation_mode
+from utils import get_tags_registry
 
 
 
@@ -97,6 +98,7 @@ class Tag_View(Details_View):
     reverse = True
     search_on_current_folder = False
     search_on_current_folder_recursive = True
+    cache_fragments = True
     # Display sidebar
     display_sidebar = True
 
@@ -153,24 +155,20 @@ class TagsFolder_TagCloud(STLView):
             query = {'format': self.formats}
             tag_base_link = '%s?%s' % (tag_base_link, encode_query(query))
 
-        # query
-        root = context.root
-        tags_query = tags_folder.get_tags_query_terms(formats=self.formats)
-        tags_results = root.search(AndQuery(*tags_query))
+        # Number of items by tag
+        tags_counts = tags_folder.get_tags_counts(context,
+                                                  formats=self.formats)
 
         items_nb = []
         tags = []
-        ac = tags_folder.get_access_control()
+        registry = get_tags_registry(context, tags_folder.get_site_root())
         for brain in tag_brains:
             # Check ACL
-            # FIXME To improve, use catalog instead resource
-            tag = tags_folder.get_resource(brain.name)
-            if ac.is_allowed_to_view(context.user, tag) is False:
+            if not registry.is_visible(brain.name):
                 continue
             if self.tags_to_show and len(items_nb) == self.tags_to_show:
                 break
-            sub_results = tags_results.search(PhraseQuery('tags', brain.name))
-            nb_items = len(sub_results)
+            nb_items = tags_counts.get(brain.name, 0)
             if nb_items:
                 d = {}
                 title = brain.title or brain.name
@@ -234,13 +232,7 @@ class TagsFolder_BrowseContent(Folder_BrowseContent):
 
 
     def _get_nb_resource_with_tag(self, resource, context, tag_name):
-        # Build the search query
-        query = resource.get_tags_query_terms()
-        query.append(PhraseQuery('tags', tag_name))
-        query = AndQuery(*query)
-
-        # Search
-        return len(context.root.search(query))
+        return resource.get_tags_counts(context).get(tag_name, 0)
 
 
     def get_key_sorted_by_items_nb(self):
@@ -15,8 +15,23 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+# Import from the Standard Library
+from datetime import datetime
+
+# Import from itools
+from itools.database import AndQuery, PhraseQuery
+from itools.uri import encode_query
+
 # Import from ikaaro
 from ikaaro.registry import get_resource_class
+from ikaaro.utils import get_base_path_query
+
+# Import from itws
+from itws.catalog import cached_search, get_link_from_path
+from itws.catalog import filter_view_acl, get_view_acl_query
+from itws.catalog import get_document_value, get_shared_generation
+from itws.catalog import register_index_hook
+from itws.catalog import select_display_value
 
 
 
@@ -35,3 +50,266 @@ def register_tags_aware(resource_class):
 def get_registered_tags_aware_classes():
     return [ get_resource_class(class_id)
              for class_id in tags_aware_registry ]
+
+
+
+##########################################################################
+# Tags of the request
+##########################################################################
+class TagsRegistry(object):
+    """The tags of a tags folder the user is allowed to see, with their
+    title and link. Built with one search, once by request (see
+    "get_tags_registry").
+    """
+
+    def __init__(self, context, tags_folder):
+        abspath = str(tags_folder.get_canonical_path())
+        query = [ get_base_path_query(abspath, depth=1),
+                  PhraseQuery('format', tags_folder.tag_class.class_id) ]
+        acl_query = get_view_acl_query(context)
+        if acl_query is not None:
+            query.append(acl_query)
+        results = cached_search(context.root, AndQuery(*query))
+        results = filter_view_acl(context, results)
+
+        # {name: {'title': title, 'href': link}}
+        self.tags = {}
+        for brain in results.get_documents():
+            title = select_display_value(context, brain.display_title)
+            title = title or brain.title or unicode(brain.name)
+            link = get_link_from_path(context, brain.abspath)
+            self.tags[brain.name] = {'title': title, 'href': link}
+
+
+    def is_visible(self, name):
+        return name in self.tags
+
+
+    def get_tags_namespace(self, context, names):
+        # Keep the query
+        query = encode_query(context.uri.query)
+
+        namespace = []
+        for name in names:
+            tag = self.tags.get(name)
+            if tag is None:
+                continue
+            href = tag['href']
+            if query:
+                href = '%s?%s' % (href, query)
+            namespace.append({'title': tag['title'], 'href': href})
+        return namespace
+
+
+
+def get_tags_registry(context, site_root=None):
+    """Return the tags registry of the website, shared by all the views of
+    the request.
+    """
+    if site_root is None:
+        site_root = context.site_root
+    registries = getattr(context, '_tags_registries', None)
+    if registries is None:
+        registries = context._tags_registries = {}
+    key = str(site_root.get_canonical_path())
+    registry = registries.get(key)
+    if registry is None:
+        tags_folder = site_root.get_resource('tags')
+        registry = registries[key] = TagsRegistry(context, tags_folder)
+    return registry
+
+
+
+##########################################################################
+# Tags index
+##########################################################################
+min_datetime = datetime(1900, 1, 1)
+
+def get_utc_datetime(value):
+    """Return the date without time zone, in UTC if it has one, to compare
+    the dates of the documents.
+    """
+    if value is None:
+        return min_datetime
+    offset = value.utcoffset()
+    if offset is None:
+        return value
+    return value.replace(tzinfo=None) - offset
+
+
+
+class TagsIndex(object):
+    """The tags of the tagged documents of a website, built with one
+    search then kept up to date when the catalog is committed (see
+    "update_tags_indexes").
+    """
+
+    # Neighbours kept by document
+    top_k = 20
+    # The values kept by document
+    stored_values = ['name', 'tags', 'workflow_state', 'format',
+                     'pub_datetime', 'display_title', 'view_acl']
+
+
+    def __init__(self, root, abspath):
+        self.abspath = abspath
+        # Built again when another process commits
+        self.generation = get_shared_generation()
+        # The stored values of the documents, to count the tags and to
+        # display the related documents {abspath: {name: value}}
+        self.documents = {}
+        # {(workflow_state, format): {tag: count}}
+        self.counts = {}
+        # The tags found together in the public documents
+        # {tag: {other: count}}
+        self.cooccurrences = {}
+        # The public documents by tag {tag: set([abspath, ...])}
+        self.inverted = {}
+        # The neighbours computed since the last change of a document
+        # sharing tags {abspath: [abspath, ...]}
+        self.neighbours = {}
+
+        query = AndQuery(PhraseQuery('parent_paths', abspath),
+                         PhraseQuery('is_tagsaware', True))
+        for document in root.search(query).get_documents():
+            self.add(document.abspath, document)
+
+
+    def contains(self, abspath):
+        if self.abspath == '/':
+            return True
+        return abspath.startswith(self.abspath + '/')
+
+
+    def add(self, abspath, document):
+        record = {}
+        for name in self.stored_values:
+            record[name] = get_document_value(document, name)
+        tags = record['tags'] = tuple(set(record['tags'] or []))
+        state = record['workflow_state']
+        format = record['format']
+        self.documents[abspath] = record
+
+        counts = self.counts.setdefault((state, format), {})
+        for tag in tags:
+            counts[tag] = counts.get(tag, 0) + 1
+
+        if state == 'public':
+            for tag in tags:
+                counts = self.cooccurrences.setdefault(tag, {})
+                for other in tags:
+                    if other != tag:
+                        counts[other] = counts.get(other, 0) + 1
+                self.inverted.setdefault(tag, set()).add(abspath)
+            self.drop_neighbours(abspath, tags)
+
+
+    def remove(self, abspath):
+        record = self.documents.pop(abspath, None)
+        if record is None:
+            return
+        tags = record['tags']
+        state = record['workflow_state']
+        format = record['format']
+
+        counts = self.counts[(state, format)]
+        for tag in tags:
+            counts[tag] -= 1
+            if counts[tag] == 0:
+                del counts[tag]
+
+        if state == 'public':
+            for tag in tags:
+                counts = self.cooccurrences[tag]
+                for other in tags:
+                    if other != tag:
+                        counts[other] -= 1
+                        if counts[other] == 0:
+                            del counts[other]
+                self.inverted[tag].discard(abspath)
+            self.drop_neighbours(abspath, tags)
+
+
+    def drop_neighbours(self, abspath, tags):
+        """Forget the neighbours of the documents sharing the given tags,
+        they are computed again when asked for.
+        """
+        self.neighbours.pop(abspath, None)
+        for tag in tags:
+            for other in self.inverted.get(tag, []):
+                self.neighbours.pop(other, None)
+
+
+    def get_counts(self, state=None, formats=[]):
+        """Return the number of documents by tag {name: count}.
+        """
+        counts = {}
+        for (doc_state, doc_format), doc_counts in self.counts.iteritems():
+            if state and doc_state != state:
+                continue
+            if formats and doc_format not in formats:
+                continue
+            for tag, count in doc_counts.iteritems():
+                counts[tag] = counts.get(tag, 0) + count
+        return counts
+
+
+    def get_cooccurrences(self, name):
+        """Return the tags found with the given tag in the public
+        documents, the most frequent first [(name, count), ...].
+        """
+        counts = self.cooccurrences.get(name, {})
+        key = lambda (tag, count): (-count, tag)
+        return sorted(counts.items(), key=key)
+
+
+    def get_neighbours(self, abspath):
+        """Return the paths of the public documents sharing most tags with
+        the given one, then the most recent first.
+        """
+        neighbours = self.neighbours.get(abspath)
+        if neighbours is not None:
+            return neighbours
+
+        record = self.documents.get(abspath)
+        if record is None:
+            return []
+        scores = {}
+        for tag in record['tags']:
+            for other in self.inverted.get(tag, []):
+                if other != abspath:
+                    scores[other] = scores.get(other, 0) + 1
+
+        def key(other):
+            pub_datetime = self.documents[other]['pub_datetime']
+            return (scores[other], get_utc_datetime(pub_datetime))
+        others = sorted(scores, key=key, reverse=True)
+        neighbours = others[:self.top_k]
+        self.neighbours[abspath] = neighbours
+        return neighbours
+
+
+
+# The indexes of the websites {abspath: TagsIndex}
+tags_indexes = {}
+
+def get_tags_index(root, site_root):
+    abspath = str(site_root.get_canonical_path())
+    index = tags_indexes.get(abspath)
+    if index is None or index.generation != get_shared_generation():
+        index = tags_indexes[abspath] = TagsIndex(root, abspath)
+    return index
+
+
+def update_tags_indexes(documents):
+    for abspath, document in documents.iteritems():
+        for index in tags_indexes.itervalues():
+            if not index.contains(abspath):
+                continue
+            index.remove(abspath)
+            if document is None:
+                continue
+            if get_document_value(document, 'is_tagsaware'):
+                index.add(abspath, document)
+
+register_index_hook(update_tags_indexes)
@@ -36,6 +36,7 @@ from ikaaro.utils import make_stl_template
 from ikaaro.workflow import WorkflowAware
 
 # Import from itws
+from itws.cache import get_data_cache, single_flight
 from itws.enumerates import DynamicEnumerate
 
 
@@ -325,39 +326,65 @@ def is_navigation_mode(context):
 # Resource with cache
 ############################################################
 class ResourceWithCache(DBResource):
-    """Resource with cache inside the metadata handler"""
-
+    """Resource with cached remote data, the entries are stored by
+    itws.cache and expire after "cache_ttl".
+    """
 
-    def __init__(self, metadata):
-        DBResource.__init__(self, metadata)
-        # Add cache API
-        timestamp = getattr(metadata, 'timestamp', None)
-        # If timestamp is None, the metadata handler could not exists on
-        # filesystem
-        # -> make_resource, check if the metadata is already loaded before
-        # setting the cache properties
-        if timestamp and getattr(metadata, 'cache_mtime', None) is None:
-            metadata.cache_mtime = None
-            metadata.cache_data = None
-            metadata.cache_errors = None
+    cache_ttl = timedelta(minutes=5)
+    # Time to wait for the refresh started by another request, when there
+    # is nothing to serve meanwhile (in seconds)
+    cache_wait = 10
 
 
     def _update_data(self):
+        """Download the data and store it with "set_cached_data".
+        """
         raise NotImplementedError
 
 
+    def get_cache_key(self):
+        # The mtime changes with the configuration of the resource
+        return '%s:%s:%s' % (self.class_id, self.get_abspath(),
+                             self.get_mtime())
+
+
+    def get_cache_entry(self):
+        """Return the cache entry {'mtime', 'data', 'errors'} or None.
+        """
+        return get_data_cache().get(self.get_cache_key())
+
+
+    def set_cached_data(self, data, errors):
+        entry = {'mtime': datetime.now(), 'data': data, 'errors': errors}
+        get_data_cache().set(self.get_cache_key(), entry)
+
+
+    def is_cache_entry_fresh(self, entry):
+        if entry is None:
+            return False
+        return datetime.now() - entry['mtime'] <= self.cache_ttl
+
+
     def get_cached_data(self):
         # Download or send the cache ??
-        metadata = self.metadata
-        now = datetime.now()
-        cache_mtime = metadata.cache_mtime
-        update_delta = timedelta(minutes=5) # 5 minutes
-        if (cache_mtime is None or
-            now - cache_mtime > update_delta):
-            print u'UPDATE CACHE'
-            self._update_data()
-
-        return metadata.cache_data, metadata.cache_errors
+        key = self.get_cache_key()
+        entry = self.get_cache_entry()
+        if not self.is_cache_entry_fresh(entry):
+            # Maybe another process did the job
+            shared_entry = get_data_cache().get_shared(key)
+            if self.is_cache_entry_fresh(shared_entry):
+                entry = shared_entry
+            else:
+                # Only one refresh at the same time, the other requests
+                # get the stale data (or wait for the first one)
+                entry = entry or shared_entry
+                timeout = 0 if entry is not None else self.cache_wait
+                single_flight.run(key, self._update_data, timeout)
+                entry = self.get_cache_entry() or entry
+
+        if entry is None:
+            return None, None
+        return entry['data'], entry['errors']
 
 
 
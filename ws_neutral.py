@@ -49,9 +49,11 @@ from ikaaro.website import WebSite
 from OPML import RssFeeds
 from about import AboutITWS
 from bar import HTMLContent, Website_BarAware, Section
+from catalog import cached_search
 from control_panel import CPEdit404, CPEditRobotsTXT, CPFOSwitchMode
 from control_panel import CPEditTags, CPDBResource_CommitLog
 from control_panel import CPManageHomePageMedia, ITWS_ControlPanel
+from control_panel import CPFetchMetrics, CPFetchMetrics_JSON
 from feed_views import Search_View
 from section_views import SectionViews_Enumerate
 from news import NewsFolder
@@ -89,7 +91,7 @@ class NeutralWS(Website_BarAware, WebSite):
     """
 
     class_id = 'neutral'
-    class_version = '20101015'
+    class_version = '20110701'
     class_title = MSG(u'ITWS Web Site')
     class_description = MSG(u'Create a new ITWS Web Site')
     class_icon16 = 'common/icons/16x16/itws-website.png'
@@ -105,7 +107,8 @@ class NeutralWS(Website_BarAware, WebSite):
                           Website_BarAware.class_control_panel +
                           ['edit_tags', 'edit_footer', 'edit_turning_footer',
                            'edit_404', 'edit_robots_txt',
-                           'manage_home_page_media', 'commit_log'])
+                           'manage_home_page_media', 'commit_log',
+                           'fetch_metrics'])
 
     __fixed_handlers__ = (WebSite.__fixed_handlers__ +
                           Website_BarAware.__fixed_handlers__ +
@@ -247,10 +250,10 @@ class NeutralWS(Website_BarAware, WebSite):
         query = [get_base_path_query(abspath, depth=1),
                  PhraseQuery('format', self.newsfolder_class.class_id)]
         # Search
-        results = context.root.search(AndQuery(*query), sort_by='name')
+        results = cached_search(context.root, AndQuery(*query))
         if len(results):
             database = context.database
-            doc = results.get_documents()[0]
+            doc = results.get_documents(sort_by='name', size=1)[0]
             path = doc.abspath
             if type(context.database) is not ROGitDatabase:
                 path = database.resources_old2new.get(path, path)
@@ -266,10 +269,13 @@ class NeutralWS(Website_BarAware, WebSite):
     ###########################################################################
     # ACL
     ###########################################################################
+    # Indexed apart, see itws.catalog.get_view_acl
+    view_acl_checked_classes = (Tracker, Tracker.issue_class)
+
     def is_allowed_to_view(self, user, resource):
         proxy = super(NeutralWS, self)
         # XXX Temporary hack for tracker
-        if isinstance(resource, (Tracker, Tracker.issue_class)):
+        if isinstance(resource, self.view_acl_checked_classes):
             # Tracker/Issue are visible if the user can edit them
             return proxy.is_allowed_to_edit(user, resource)
         return proxy.is_allowed_to_view(user, resource)
@@ -297,6 +303,8 @@ class NeutralWS(Website_BarAware, WebSite):
     edit_robots_txt = CPEditRobotsTXT()
     fo_switch_mode = CPFOSwitchMode()
     manage_home_page_media = CPManageHomePageMedia()
+    fetch_metrics = CPFetchMetrics()
+    fetch_metrics_json = CPFetchMetrics_JSON()
 
 
     ###########################################
@@ -489,6 +497,13 @@ class NeutralWS(Website_BarAware, WebSite):
                 resource.metadata.set_property('pub_datetime', utc_datetime)
 
 
+    def update_20110701(self):
+        """Index the access control of the feed views (view_acl)"""
+        database = get_context().database
+        for resource in self.traverse_resources():
+            database.change_resource(resource)
+
+
 
 ############################################################
 # Register